@@ -0,0 +1,154 @@
+"""
+Memoria por transacción del store en memoria: dicts vs CompactRecord.
+
+Llena un MemoryTransactionStore con N transacciones con la forma que deja
+main.py (reserva pendiente creada por n8n; una fracción confirmada con el
+detalle de Transbank) y mide cuánto creció el RSS del proceso. Cada modo
+corre en un subproceso propio para que no se mezclen los heaps.
+
+    python bench/memory.py --entries 1000000
+    python bench/memory.py --entries 200000 --modes dict,compact --tracemalloc
+"""
+import argparse
+import asyncio
+import gc
+import json
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+MODES = {
+    "dict": {"compact": False},
+    "compact": {"compact": True},
+    # Sólo lo que se muestra en la página de resultado y se manda a n8n
+    "compact-trimmed": {
+        "compact": True,
+        "details_fields": ("status", "amount", "authorization_code", "card_detail", "transaction_date"),
+    },
+}
+
+SERVICES = ["Masaje", "Limpieza facial", "Manicure", "Depilación", "Corte de pelo"]
+
+
+def rss_bytes() -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def transbank_details(buy_order: str, amount: int, rng: random.Random) -> dict:
+    # Misma forma que la respuesta de commit de Webpay Plus (ver bench/mocks.py)
+    return {
+        "vci": "TSY",
+        "amount": amount,
+        "status": "AUTHORIZED",
+        "buy_order": buy_order,
+        "session_id": f"SESS{rng.getrandbits(48):x}",
+        "card_detail": {"card_number": f"{rng.randrange(10000):04d}"},
+        "accounting_date": time.strftime("%m%d"),
+        "transaction_date": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+        "authorization_code": f"{rng.randrange(1000000):06d}",
+        "payment_type_code": "VN",
+        "response_code": 0,
+        "installments_number": 0,
+    }
+
+
+async def fill(store, entries: int, finished_ratio: float) -> None:
+    from ids import new_buy_order
+
+    rng = random.Random(42)
+    for i in range(entries):
+        token = f"{rng.getrandbits(256):064x}"
+        buy_order = new_buy_order("RES")
+        amount = rng.choice([15000, 20000, 25000, 35000])
+        await store.set(token, {
+            "status": "pending",
+            "reserva_data": {
+                "name": f"Cliente {i}",
+                "email": f"cliente{i}@example.com",
+                "start_time": "2026-01-01T10:00:00",
+                "end_time": "2026-01-01T11:00:00",
+                "amount": amount,
+                "service_name": rng.choice(SERVICES),
+                "phone": f"+569{rng.randrange(10**8):08d}",
+                "service_id": None,
+            },
+            "buy_order": buy_order,
+            "amount": amount,
+            "created_at": time.time(),
+        })
+        if rng.random() < finished_ratio:
+            # JSON ida y vuelta: como llega de httpx, con strings propios
+            details = json.loads(json.dumps(transbank_details(buy_order, amount, rng)))
+            await store.update(token, {
+                "status": details["status"],
+                "updated_at": time.time(),
+                "details": details,
+            })
+
+
+def measure(mode: str, entries: int, finished_ratio: float, use_tracemalloc: bool) -> dict:
+    from store import ExpiryPolicy, MemoryTransactionStore
+
+    policy = ExpiryPolicy(pending_ttl=10**9, finished_ttl=10**9)
+    gc.collect()
+    if use_tracemalloc:
+        tracemalloc.start()
+    before = rss_bytes()
+    start = time.perf_counter()
+    store = MemoryTransactionStore(policy, **MODES[mode])
+    asyncio.run(fill(store, entries, finished_ratio))
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    result = {
+        "mode": mode,
+        "entries": entries,
+        "fill_seconds": round(elapsed, 2),
+        "rss_bytes_per_transaction": round((rss_bytes() - before) / entries),
+        "approx_record_bytes_per_transaction": round(store._bytes / entries),
+    }
+    if use_tracemalloc:
+        current, _ = tracemalloc.get_traced_memory()
+        result["traced_bytes_per_transaction"] = round(current / entries)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=1_000_000)
+    parser.add_argument("--finished-ratio", type=float, default=0.7, help="fracción confirmada")
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--tracemalloc", action="store_true", help="medir también con tracemalloc (lento)")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child, args.entries, args.finished_ratio, args.tracemalloc)))
+        return
+
+    results = []
+    for mode in args.modes.split(","):
+        if mode not in MODES:
+            raise SystemExit(f"Modo desconocido: {mode} (disponibles: {', '.join(MODES)})")
+        command = [
+            sys.executable, __file__, "--child", mode,
+            "--entries", str(args.entries), "--finished-ratio", str(args.finished_ratio),
+        ]
+        if args.tracemalloc:
+            command.append("--tracemalloc")
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Servidores falsos de Transbank, MercadoPago y n8n para los benchmarks.
+
+Cada mock responde con la forma de la API real (lo que main.py lee) y con
+una latencia y tasa de error configurables, sin salir a internet.
+"""
+import asyncio
+import itertools
+import math
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+TBK_PATH = "/rswebpaytransaction/api/webpay/v1.2/transactions"
+
+
+@dataclass
+class Latency:
+    """
+    Distribución de latencia en milisegundos. Formatos aceptados por `parse`:
+    `0`, `fixed:20`, `uniform:10:50`, `lognormal:<mediana>:<sigma>`.
+    """
+
+    kind: str = "fixed"
+    a: float = 0.0
+    b: float = 0.0
+
+    @classmethod
+    def parse(cls, spec: str) -> "Latency":
+        parts = spec.split(":")
+        if len(parts) == 1:
+            return cls("fixed", float(parts[0]))
+        kind, *values = parts
+        values = [float(v) for v in values] + [0.0, 0.0]
+        return cls(kind, values[0], values[1])
+
+    def sample(self) -> float:
+        """Segundos a esperar."""
+        if self.kind == "uniform":
+            ms = random.uniform(self.a, self.b)
+        elif self.kind == "lognormal":
+            ms = random.lognormvariate(math.log(max(self.a, 0.001)), self.b)
+        else:
+            ms = self.a
+        return ms / 1000
+
+
+@dataclass
+class MockBehavior:
+    latency: Latency = field(default_factory=Latency)
+    error_rate: float = 0.0
+
+    async def delay_or_fail(self):
+        """Espera la latencia simulada; devuelve un 503 si toca fallar."""
+        delay = self.latency.sample()
+        if delay:
+            await asyncio.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            return Response("mock error", status_code=503)
+        return None
+
+
+def transbank_app(behavior: MockBehavior, authorize_rate: float = 1.0) -> Starlette:
+    """
+    API REST Webpay Plus v1.2: crear, confirmar (commit) y consultar estado,
+    más el formulario de pago (`POST /webpayserver/initTransaction?token_ws=`): pagar
+    deja el token AUTHORIZED o FAILED sin confirmar, como cuando el cliente
+    paga y no vuelve. Sin pasar por el formulario el commit decide el estado.
+    """
+    tokens = {}
+    counter = itertools.count()
+
+    async def create(request: Request):
+        error = await behavior.delay_or_fail()
+        if error:
+            return error
+        body = await request.json()
+        token = f"01ab{next(counter):060x}"
+        tokens[token] = {**body, "status": "INITIALIZED"}
+        return JSONResponse({
+            "token": token,
+            "url": f"{request.base_url}webpayserver/initTransaction",
+        })
+
+    def detail(token: str) -> dict:
+        tx = tokens[token]
+        return {
+            "vci": "TSY",
+            "amount": tx["amount"],
+            "status": tx["status"],
+            "buy_order": tx["buy_order"],
+            "session_id": tx["session_id"],
+            "card_detail": {"card_number": "6623"},
+            "accounting_date": time.strftime("%m%d"),
+            "transaction_date": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+            "authorization_code": "1213",
+            "payment_type_code": "VN",
+            "response_code": 0 if tx["status"] == "AUTHORIZED" else -1,
+            "installments_number": 0,
+        }
+
+    async def commit(request: Request):
+        error = await behavior.delay_or_fail()
+        if error:
+            return error
+        token = request.path_params["token"]
+        tx = tokens.get(token)
+        if tx is None:
+            return JSONResponse({"error_message": "Invalid value for parameter: token"}, 422)
+        if tx.get("committed"):
+            return JSONResponse({"error_message": "Transaction already locked by another process"}, 422)
+        if tx["status"] == "INITIALIZED":
+            tx["status"] = "AUTHORIZED" if random.random() < authorize_rate else "FAILED"
+        tx["committed"] = True
+        return JSONResponse(detail(token))
+
+    async def pay(request: Request):
+        tx = tokens.get(request.query_params.get("token_ws"))
+        if tx is None or tx["status"] != "INITIALIZED":
+            return JSONResponse({"error_message": "Invalid token"}, 422)
+        tx["status"] = "AUTHORIZED" if random.random() < authorize_rate else "FAILED"
+        return JSONResponse({"status": tx["status"]})
+
+    async def status(request: Request):
+        error = await behavior.delay_or_fail()
+        if error:
+            return error
+        token = request.path_params["token"]
+        if token not in tokens:
+            return JSONResponse({"error_message": "Invalid value for parameter: token"}, 422)
+        return JSONResponse(detail(token))
+
+    return Starlette(routes=[
+        Route(TBK_PATH, create, methods=["POST"]),
+        Route(TBK_PATH + "/{token}", commit, methods=["PUT"]),
+        Route(TBK_PATH + "/{token}", status, methods=["GET"]),
+        Route("/webpayserver/initTransaction", pay, methods=["POST"]),
+    ])
+
+
+def mercadopago_app(behavior: MockBehavior) -> Starlette:
+    """Preferencias de checkout y consulta de pagos."""
+    counter = itertools.count(1)
+
+    async def create_preference(request: Request):
+        error = await behavior.delay_or_fail()
+        if error:
+            return error
+        body = await request.json()
+        pref_id = f"123456-{next(counter)}"
+        return JSONResponse({
+            "id": pref_id,
+            "external_reference": body.get("external_reference"),
+            "init_point": f"{request.base_url}checkout?pref_id={pref_id}",
+            "sandbox_init_point": f"{request.base_url}sandbox?pref_id={pref_id}",
+        }, status_code=201)
+
+    async def get_payment(request: Request):
+        error = await behavior.delay_or_fail()
+        if error:
+            return error
+        payment_id = request.path_params["payment_id"]
+        return JSONResponse({
+            "id": int(payment_id),
+            "status": "approved",
+            "status_detail": "accredited",
+            "external_reference": f"ORDER_MP_BENCH{payment_id}",
+            "transaction_amount": 5000,
+            "date_last_updated": time.strftime("%Y-%m-%dT%H:%M:%S.000-04:00"),
+        })
+
+    return Starlette(routes=[
+        Route("/checkout/preferences", create_preference, methods=["POST"]),
+        Route("/v1/payments/{payment_id}", get_payment, methods=["GET"]),
+    ])
+
+
+class WebhookSink:
+    """Receptor de webhooks (n8n): cuenta entregas y claves de idempotencia únicas."""
+
+    def __init__(self, behavior: MockBehavior):
+        self.behavior = behavior
+        self.received = 0
+        self.keys = set()
+        self.app = Starlette(routes=[Route("/{path:path}", self.receive, methods=["POST"])])
+
+    async def receive(self, request: Request):
+        error = await self.behavior.delay_or_fail()
+        if error:
+            return error
+        await request.body()
+        self.received += 1
+        self.keys.add(request.headers.get("idempotency-key"))
+        return JSONResponse({"ok": True})
+
+
+class ServerThread:
+    """Corre una app ASGI con uvicorn en un thread propio (con su event loop)."""
+
+    def __init__(self, app, host: str = "127.0.0.1", port: int = 0):
+        config = uvicorn.Config(app, host=host, port=port, log_level="warning", access_log=False)
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def start(self) -> str:
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        sock = self.server.servers[0].sockets[0]
+        host, port = sock.getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    def stop(self) -> None:
+        self.server.should_exit = True
+        self.thread.join(timeout=5)
@@ -0,0 +1,185 @@
+"""
+Costo del WAL del store en memoria y tiempo de recuperación al reiniciar.
+
+1. Llena un MemoryTransactionStore sin WAL y con WAL (TRANSACTION_WAL_DIR)
+   y compara la latencia de cada escritura (set / update).
+2. Recupera el store desde el WAL completo.
+3. Toma un snapshot, escribe una cola de `--tail` operaciones más y vuelve
+   a recuperar (snapshot + WAL posterior, el caso normal).
+
+Cada paso corre en un subproceso propio.
+
+    python bench/recovery.py --entries 1000000
+    python bench/recovery.py --entries 200000 --dir /tmp/wal
+"""
+import argparse
+import asyncio
+import json
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from memory import SERVICES, rss_bytes, transbank_details
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def open_store(directory):
+    from persistence import TransactionLog
+    from store import ExpiryPolicy, MemoryTransactionStore
+
+    policy = ExpiryPolicy(pending_ttl=10**9, finished_ttl=10**9)
+    # Snapshots sólo cuando el benchmark los pide
+    log = TransactionLog(directory, snapshot_interval=10**9, snapshot_wal_bytes=2**62) if directory else None
+    return MemoryTransactionStore(policy, log=log)
+
+
+async def write(store, entries, finished_ratio, seed):
+    from ids import new_buy_order
+
+    rng = random.Random(seed)
+    runner = asyncio.create_task(store.run())
+    latencies = []
+    for i in range(entries):
+        token = f"{rng.getrandbits(256):064x}"
+        buy_order = new_buy_order("RES")
+        amount = rng.choice([15000, 20000, 25000, 35000])
+        record = {
+            "status": "pending",
+            "reserva_data": {
+                "name": f"Cliente {i}",
+                "email": f"cliente{i}@example.com",
+                "start_time": "2026-01-01T10:00:00",
+                "end_time": "2026-01-01T11:00:00",
+                "amount": amount,
+                "service_name": rng.choice(SERVICES),
+                "phone": f"+569{rng.randrange(10**8):08d}",
+                "service_id": None,
+            },
+            "buy_order": buy_order,
+            "amount": amount,
+            "created_at": time.time(),
+        }
+        start = time.perf_counter()
+        await store.set(token, record)
+        latencies.append(time.perf_counter() - start)
+        if rng.random() < finished_ratio:
+            details = json.loads(json.dumps(transbank_details(buy_order, amount, rng)))
+            fields = {"status": details["status"], "updated_at": time.time(), "details": details}
+            start = time.perf_counter()
+            await store.update(token, fields)
+            latencies.append(time.perf_counter() - start)
+        if i % 100 == 0:
+            # Como entre requests: deja correr el group commit
+            await asyncio.sleep(0)
+    runner.cancel()
+    return latencies
+
+
+def child_write(args):
+    async def main():
+        store = open_store(args.dir)
+        start = time.perf_counter()
+        latencies = await write(store, args.entries, args.finished_ratio, seed=42)
+        elapsed = time.perf_counter() - start
+        await store.close()
+        return {
+            "step": "write",
+            "wal": bool(args.dir),
+            "writes": len(latencies),
+            "seconds": round(elapsed, 2),
+            "mean_us": round(sum(latencies) / len(latencies) * 1e6, 1),
+            "p99_us": round(percentile(latencies, 0.99) * 1e6, 1),
+            "max_ms": round(max(latencies) * 1e3, 2),
+        }
+
+    return asyncio.run(main())
+
+
+def child_snapshot(args):
+    async def main():
+        store = open_store(args.dir)
+        start = time.perf_counter()
+        await store._log.snapshot(store._capture)
+        snapshot_seconds = time.perf_counter() - start
+        await write(store, args.tail, args.finished_ratio, seed=7)
+        await store.close()
+        return {"step": "snapshot", "seconds": round(snapshot_seconds, 2), "tail": args.tail}
+
+    return asyncio.run(main())
+
+
+def child_recover(args):
+    async def main():
+        before = rss_bytes()
+        start = time.perf_counter()
+        store = open_store(args.dir)
+        elapsed = time.perf_counter() - start
+        count, _ = await store.stats()
+        await store.close()
+        return {
+            "step": "recover",
+            "files": sorted(p.name for p in Path(args.dir).iterdir() if p.name != "LOCK"),
+            "entries": count,
+            "seconds": round(elapsed, 2),
+            "rss_mb": round((rss_bytes() - before) / 2**20),
+        }
+
+    return asyncio.run(main())
+
+
+CHILDREN = {"write": child_write, "snapshot": child_snapshot, "recover": child_recover}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=1_000_000)
+    parser.add_argument("--finished-ratio", type=float, default=0.7, help="fracción confirmada")
+    parser.add_argument("--tail", type=int, default=50_000, help="escrituras después del snapshot")
+    parser.add_argument("--dir", help="directorio del WAL (default: uno temporal)")
+    parser.add_argument("--child", choices=CHILDREN, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(CHILDREN[args.child](args)))
+        return
+
+    directory = args.dir or tempfile.mkdtemp(prefix="wal-bench-")
+    shutil.rmtree(directory, ignore_errors=True)
+
+    def run(step, wal=True):
+        command = [
+            sys.executable, __file__, "--child", step, "--entries", str(args.entries),
+            "--finished-ratio", str(args.finished_ratio), "--tail", str(args.tail),
+        ]
+        if wal:
+            command += ["--dir", directory]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        return json.loads(output)
+
+    try:
+        results = [
+            run("write", wal=False),
+            run("write"),
+            run("recover"),
+            run("snapshot"),
+            run("recover"),
+        ]
+    finally:
+        if not args.dir:
+            shutil.rmtree(directory, ignore_errors=True)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""
+Benchmark de carga de main.py contra mocks locales de Transbank, MercadoPago y n8n.
+
+Levanta los mocks (bench/mocks.py), arranca la app con uvicorn en un
+subproceso apuntando a ellos y la recorre con usuarios virtuales que
+ejecutan una mezcla de escenarios:
+
+    reserva    POST /api/reserva/crear-pago -> POST /api/confirm-payment
+               (y el aviso a n8n, que se mide al drenar el outbox)
+    payment    POST /api/create-payment -> POST /api/confirm-payment
+    mp_notify  POST /api/mp/notifications
+    mp_preference  POST /api/mp/create-preference (ítems del catálogo)
+    mp_payment GET /api/mp/payment/{id}, sobre MP_PAYMENT_IDS ids como el
+               polling del frontend (pega también en el cache de pagos)
+    products   GET /api/products
+
+Al final imprime (o guarda con --output) un JSON con requests/s, p50/p95/p99
+por paso, códigos de estado, avisos entregados a n8n y RSS máximo de la app.
+
+    python bench/run.py --users 50 --duration 30 --workers 2 --store sqlite \\
+        --tbk-latency lognormal:80:0.4 --n8n-error-rate 0.05 --output run.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import httpx
+
+from mocks import Latency, MockBehavior, ServerThread, WebhookSink, mercadopago_app, transbank_app
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(latencies):
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3) if ordered else None,
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 3) if ordered else None,
+        "p95_ms": round(percentile(ordered, 0.95) * 1000, 3) if ordered else None,
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 3) if ordered else None,
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def process_tree_rss(pid):
+    """RSS en bytes del proceso y sus hijos (workers de uvicorn), vía /proc."""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            continue
+    return total
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.status_codes = Counter()
+        self.errors = 0
+        self.authorized_reservations = 0
+
+    async def call(self, client, step, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.errors += 1
+            self.status_codes["exception"] += 1
+            return None
+        self.latencies[step].append(time.perf_counter() - start)
+        self.status_codes[str(response.status_code)] += 1
+        if response.status_code >= 400:
+            self.errors += 1
+        return response
+
+
+RESERVA_START = datetime(2026, 1, 1)
+
+
+def reserva(n):
+    """Una reserva distinta por iteración: otro cliente y otra hora (sin replays ni 409)."""
+    start = RESERVA_START + timedelta(hours=n)
+    return {
+        "name": f"Bench {n}",
+        "email": f"bench{n}@example.com",
+        "start_time": start.isoformat(),
+        "end_time": (start + timedelta(hours=1)).isoformat(),
+        "amount": 15000,
+        "service_name": "Masaje",
+        "phone": "+56900000000",
+    }
+
+
+async def scenario_reserva(client, rec, n):
+    r = await rec.call(client, "reserva_create", "POST", "/api/reserva/crear-pago", json=reserva(n))
+    if r is None or r.status_code != 200:
+        return
+    r = await rec.call(client, "reserva_confirm", "POST", "/api/confirm-payment",
+                       json={"token": r.json()["token"]})
+    if r is not None and r.status_code == 200 and r.json().get("status") == "AUTHORIZED":
+        rec.authorized_reservations += 1
+
+
+async def scenario_payment(client, rec, n):
+    r = await rec.call(client, "payment_create", "POST", "/api/create-payment", json={"amount": 5000})
+    if r is None or r.status_code != 200:
+        return
+    await rec.call(client, "payment_confirm", "POST", "/api/confirm-payment",
+                   json={"token": r.json()["token"]})
+
+
+async def scenario_mp_notify(client, rec, n):
+    await rec.call(client, "mp_notify", "POST", f"/api/mp/notifications?topic=payment&id={n}")
+
+
+async def scenario_mp_preference(client, rec, n):
+    # Ids del catálogo por defecto de main.py (products)
+    await rec.call(client, "mp_preference", "POST", "/api/mp/create-preference",
+                   json={"items": [{"id": 1 + n % 2, "quantity": 1 + n % 3}]})
+
+
+MP_PAYMENT_IDS = 500
+
+
+async def scenario_mp_payment(client, rec, n):
+    await rec.call(client, "mp_payment", "GET", f"/api/mp/payment/{1 + n % MP_PAYMENT_IDS}")
+
+
+async def scenario_products(client, rec, n):
+    await rec.call(client, "products", "GET", "/api/products")
+
+
+SCENARIOS = {
+    "reserva": scenario_reserva,
+    "payment": scenario_payment,
+    "mp_notify": scenario_mp_notify,
+    "mp_preference": scenario_mp_preference,
+    "mp_payment": scenario_mp_payment,
+    "products": scenario_products,
+}
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if name not in SCENARIOS:
+            raise SystemExit(f"Escenario desconocido: {name} (disponibles: {', '.join(SCENARIOS)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+async def drive(base_url, args, rec):
+    mix = parse_mix(args.mix)
+    names, weights = list(mix), list(mix.values())
+    counter = itertools.count(1)
+    deadline = time.monotonic() + args.duration
+    limits = httpx.Limits(max_connections=args.users, max_keepalive_connections=args.users)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=60, limits=limits) as client:
+        async def user():
+            while time.monotonic() < deadline:
+                name = random.choices(names, weights)[0]
+                await SCENARIOS[name](client, rec, next(counter))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(user() for _ in range(args.users)))
+        return time.perf_counter() - start
+
+
+def wait_ready(base_url, proc, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit("La app terminó al arrancar (revisar su salida)")
+        try:
+            if httpx.get(f"{base_url}/", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise SystemExit("La app no respondió a tiempo")
+
+
+async def sample_rss(pid, peak, stop):
+    while not stop.is_set():
+        peak[0] = max(peak[0], process_tree_rss(pid))
+        await asyncio.sleep(0.25)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="usuarios virtuales concurrentes")
+    parser.add_argument("--duration", type=float, default=15, help="segundos de carga")
+    parser.add_argument("--workers", type=int, default=1, help="workers de uvicorn")
+    parser.add_argument("--store", default="memory", help="TRANSACTION_STORE de la app")
+    parser.add_argument("--mix", default="reserva=6,payment=2,mp_notify=1,mp_preference=1,mp_payment=1,products=1")
+    parser.add_argument("--tbk-latency", default="lognormal:80:0.4")
+    parser.add_argument("--tbk-error-rate", type=float, default=0.0)
+    parser.add_argument("--tbk-authorize-rate", type=float, default=0.95)
+    parser.add_argument("--mp-latency", default="lognormal:60:0.4")
+    parser.add_argument("--mp-error-rate", type=float, default=0.0)
+    parser.add_argument("--n8n-latency", default="lognormal:150:0.6")
+    parser.add_argument("--n8n-error-rate", type=float, default=0.0)
+    parser.add_argument("--drain-timeout", type=float, default=30, help="espera máxima del outbox")
+    parser.add_argument("--output", help="archivo JSON de resultados (por defecto stdout)")
+    args = parser.parse_args()
+
+    if args.workers > 1 and args.store == "memory":
+        print("Aviso: con varios workers el store en memoria no es compartido", file=sys.stderr)
+
+    tbk = ServerThread(transbank_app(
+        MockBehavior(Latency.parse(args.tbk_latency), args.tbk_error_rate), args.tbk_authorize_rate
+    ))
+    mp = ServerThread(mercadopago_app(MockBehavior(Latency.parse(args.mp_latency), args.mp_error_rate)))
+    sink = WebhookSink(MockBehavior(Latency.parse(args.n8n_latency), args.n8n_error_rate))
+    n8n = ServerThread(sink.app)
+    tbk_url, mp_url, n8n_url = tbk.start(), mp.start(), n8n.start()
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    env = {
+        **os.environ,
+        "WEBPAY_BASE_URL": tbk_url,
+        "MP_API_BASE_URL": mp_url,
+        "N8N_CONFIRMATION_WEBHOOK": f"{n8n_url}/webhook/reserva-confirmada",
+        "TRANSACTION_STORE": args.store,
+        "TRANSACTION_STORE_PATH": os.path.join(workdir, "transactions.db"),
+        "OUTBOX_PATH": os.path.join(workdir, "outbox.db"),
+        "LOG_LEVEL": "WARNING",
+    }
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", str(REPO_DIR),
+         "--host", "127.0.0.1", "--port", str(port), "--workers", str(args.workers),
+         "--log-level", "warning", "--no-access-log"],
+        cwd=workdir, env=env,
+    )
+
+    rec = Recorder()
+    try:
+        wait_ready(base_url, proc)
+
+        async def run():
+            peak, stop = [0], asyncio.Event()
+            sampler = asyncio.create_task(sample_rss(proc.pid, peak, stop))
+            elapsed = await drive(base_url, args, rec)
+            # El aviso a n8n sale del outbox en segundo plano: esperamos a que drene
+            drain_start = time.monotonic()
+            while (
+                sink.received < rec.authorized_reservations
+                and time.monotonic() - drain_start < args.drain_timeout
+            ):
+                await asyncio.sleep(0.1)
+            drain = time.monotonic() - drain_start
+            stop.set()
+            await sampler
+            return elapsed, drain, peak[0]
+
+        elapsed, drain, peak_rss = asyncio.run(run())
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+        for server in (tbk, mp, n8n):
+            server.stop()
+
+    all_latencies = [lat for values in rec.latencies.values() for lat in values]
+    total = sum(rec.status_codes.values())
+    result = {
+        "config": vars(args),
+        "duration_s": round(elapsed, 3),
+        "requests": total,
+        "errors": rec.errors,
+        "requests_per_second": round(total / elapsed, 2) if elapsed else None,
+        "latency": {
+            "overall": summarize(all_latencies),
+            **{step: summarize(values) for step, values in sorted(rec.latencies.items())},
+        },
+        "status_codes": dict(rec.status_codes),
+        "notifications": {
+            "expected": rec.authorized_reservations,
+            "delivered": sink.received,
+            "unique": len(sink.keys),
+            "drain_s": round(drain, 3),
+        },
+        "peak_rss_mb": round(peak_rss / 1024 / 1024, 1),
+    }
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+import metrics
+from singleflight import SingleFlight
+
+
+class TTLCache:
+    """
+    Cache LRU acotado con vencimiento por entrada.
+
+    `get_or_fetch` coalesce los misses simultáneos de una misma clave: sólo
+    uno llama a `fetch` y el resto comparte su resultado. `ttl_for(value)`
+    decide cuánto vive cada valor; si devuelve 0 el valor no se guarda.
+    Los hits/misses se cuentan en `cache_requests_total{cache=<name>}`.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl_for: Callable[[Any], float]):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl_for = ttl_for
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._inflight = SingleFlight()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        ttl = self.ttl_for(value)
+        if ttl <= 0:
+            self._data.pop(key, None)
+            return
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        value = self.get(key)
+        if value is not None:
+            metrics.CACHE_REQUESTS.labels(self.name, "hit").inc()
+            return value
+
+        if key in self._inflight:
+            metrics.CACHE_REQUESTS.labels(self.name, "coalesced").inc()
+        else:
+            metrics.CACHE_REQUESTS.labels(self.name, "miss").inc()
+
+        async def fetch_and_store():
+            result = await fetch()
+            self.set(key, result)
+            return result
+
+        return await self._inflight.do(key, fetch_and_store)
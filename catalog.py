@@ -0,0 +1,161 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogSource:
+    """
+    Catálogo leído de un archivo JSON y recargado cuando el archivo cambia.
+
+    Se revisa el mtime/tamaño a lo más una vez cada `check_interval`
+    segundos, así que leer el catálogo en cada request cuesta casi nada. Sin
+    archivo se usa `default` (el catálogo definido en el código), que sólo
+    cambia con un deploy. Si el archivo falta o queda inválido se mantiene la
+    última versión buena (y se registra el error una vez por cada vez que
+    deja de poder leerse).
+
+    `configured` es True si hay archivo o un `default` no vacío: quien use el
+    catálogo para validar no debe tratar "configurado pero vacío" como "sin
+    catálogo".
+    """
+
+    def __init__(self, path: Optional[str], default: Any, check_interval: float = 1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._data = default
+        self._version = 0
+        self._stat = None
+        self._checked_at = 0.0
+        self._missing = False
+        self._lock = threading.Lock()
+        self.configured = bool(path) or bool(default)
+        if path:
+            self._reload(force=True)
+
+    def _reload(self, force: bool = False) -> None:
+        try:
+            st = os.stat(self.path)
+        except OSError as e:
+            if not self._missing:
+                logger.error(
+                    "No se puede leer el catálogo %s, se mantiene la versión anterior: %s",
+                    self.path, e,
+                )
+                self._missing = True
+            return
+        self._missing = False
+        stat = (st.st_mtime_ns, st.st_size)
+        if not force and stat == self._stat:
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error("Catálogo inválido en %s, se mantiene la versión anterior: %s", self.path, e)
+            return
+        self._data = data
+        self._stat = stat
+        self._version += 1
+
+    def get(self) -> Tuple[int, Any]:
+        """(versión, datos); la versión sube cada vez que el contenido se recarga."""
+        if self.path:
+            now = time.monotonic()
+            if now - self._checked_at >= self.check_interval:
+                with self._lock:
+                    if now - self._checked_at >= self.check_interval:
+                        self._reload()
+                        self._checked_at = now
+        return self._version, self._data
+
+
+class PrecomputedJSON:
+    """
+    Respuesta JSON serializada una sola vez por versión del catálogo, con un
+    ETag fuerte derivado del contenido.
+    """
+
+    def __init__(self, source: CatalogSource):
+        self.source = source
+        self._cached_version = None
+        self._body = b""
+        self._etag = ""
+
+    def current(self) -> Tuple[bytes, str]:
+        version, data = self.source.get()
+        if version != self._cached_version:
+            body = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            self._body = body
+            self._etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+            self._cached_version = version
+        return self._body, self._etag
+
+
+def _name_key(name: str) -> str:
+    return name.strip().lower()
+
+
+class PriceIndex:
+    """
+    Índice id -> ítem y nombre -> ítem de un catálogo (lista de
+    {"id", "name", "price", ...}), reconstruido sólo cuando la versión del
+    catálogo cambia: cada búsqueda es un acceso a diccionario. Los nombres se
+    comparan sin mayúsculas ni espacios en los bordes; los ítems sin precio
+    entero positivo se ignoran.
+    """
+
+    def __init__(self, source: CatalogSource):
+        self.source = source
+        self._cached_version = None
+        self._by_id: Dict[str, dict] = {}
+        self._by_name: Dict[str, dict] = {}
+        self._size = 0
+
+    def _current(self) -> Tuple[Dict[str, dict], Dict[str, dict]]:
+        version, data = self.source.get()
+        if version != self._cached_version:
+            by_id, by_name = {}, {}
+            size = 0
+            for item in data if isinstance(data, list) else ():
+                price = item.get("price") if isinstance(item, dict) else None
+                if not isinstance(price, int) or isinstance(price, bool) or price <= 0:
+                    logger.warning("Ítem sin precio válido en el catálogo: %r", item)
+                    continue
+                size += 1
+                if item.get("id") is not None:
+                    by_id[str(item["id"])] = item
+                if isinstance(item.get("name"), str):
+                    by_name[_name_key(item["name"])] = item
+            self._by_id, self._by_name, self._size = by_id, by_name, size
+            self._cached_version = version
+        return self._by_id, self._by_name
+
+    def __len__(self) -> int:
+        self._current()
+        return self._size
+
+    def lookup(self, id: Any = None, name: Optional[str] = None) -> Optional[dict]:
+        """El ítem con ese id o, si no se da id, con ese nombre."""
+        by_id, by_name = self._current()
+        if id is not None:
+            return by_id.get(str(id))
+        if name is not None:
+            return by_name.get(_name_key(name))
+        return None
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Compara un header If-None-Match (lista, `*` o ETags débiles) con `etag`."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
@@ -0,0 +1,83 @@
+import asyncio
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Set
+
+import metrics
+from store import TransactionStore
+
+# Estados desde los que una transacción todavía puede cambiar: los de Webpay
+# (pending) y los de MercadoPago que aún no son finales
+PENDING_STATUSES = {"pending", "in_process", "in_mediation", "authorized"}
+
+
+def is_final(record: dict) -> bool:
+    return record.get("status") not in PENDING_STATUSES
+
+
+class TransactionEvents:
+    """
+    Pub/sub en proceso de los cambios del store de transacciones, para las
+    rutas SSE y long-poll.
+
+    El store llama a `publish` tras cada set/update (y, con Redis, también
+    con las escrituras de otros workers). Cada suscriptor tiene una cola de
+    un elemento: sólo interesa el último estado, así que un cambio nuevo
+    reemplaza al que no se alcanzó a leer y un cliente lento nunca acumula.
+
+    Si el store no difunde los cambios entre workers (SQLite), quien espera
+    consulta además el store cada `poll_interval` segundos.
+    """
+
+    def __init__(self, store: TransactionStore, poll_interval: float = 2.0):
+        self.store = store
+        self.poll_interval = None if store.broadcasts_changes else poll_interval
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
+        store.add_listener(self.publish)
+
+    def publish(self, token: str, record: dict) -> None:
+        queues = self._subscribers.get(token)
+        if not queues:
+            return
+        for queue in queues:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(record)
+
+    @contextmanager
+    def subscribe(self, token: str) -> Iterator[asyncio.Queue]:
+        queue = asyncio.Queue(maxsize=1)
+        self._subscribers[token].add(queue)
+        metrics.TRANSACTION_EVENT_SUBSCRIBERS.inc()
+        try:
+            yield queue
+        finally:
+            metrics.TRANSACTION_EVENT_SUBSCRIBERS.dec()
+            queues = self._subscribers.get(token)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    del self._subscribers[token]
+
+    async def next_change(
+        self, token: str, queue: asyncio.Queue, status: Optional[str], timeout: float
+    ) -> Optional[dict]:
+        """
+        Espera un registro de `token` con estado distinto de `status`.
+        Devuelve None si no hubo cambio en `timeout` segundos.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            wait = remaining if self.poll_interval is None else min(remaining, self.poll_interval)
+            try:
+                record = await asyncio.wait_for(queue.get(), wait)
+            except asyncio.TimeoutError:
+                if self.poll_interval is None:
+                    continue
+                record = await self.store.get(token)
+            if record is not None and record.get("status") != status:
+                return record
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import time
+from typing import Awaitable, Callable, Optional, Tuple
+
+import metrics
+from singleflight import SingleFlight
+from store import IDEMPOTENCY_KIND, TransactionStore
+
+IDEMPOTENCY_PREFIX = "idem:"
+# Estados del token de una respuesta guardada que todavía vale la pena repetir
+LIVE_STATUSES = {"pending", "AUTHORIZED"}
+
+
+class IdempotencyMismatch(Exception):
+    """La misma Idempotency-Key llegó con otro cuerpo."""
+
+
+def _digest(value: str) -> str:
+    return hashlib.sha256(value.encode()).hexdigest()[:32]
+
+
+def idempotency_key(scope: str, key: str) -> str:
+    """Clave dentro del store (las keys del cliente pueden ser largas o arbitrarias)."""
+    return f"{IDEMPOTENCY_PREFIX}{scope}:{_digest(key)}"
+
+
+def fingerprint(payload: dict) -> str:
+    return _digest(json.dumps(payload, sort_keys=True, separators=(",", ":")))
+
+
+class IdempotentRequests:
+    """
+    Respuestas reutilizables para reintentos (n8n reintenta los nodos HTTP
+    ante un timeout, aunque el primer intento haya creado el link).
+
+    La primera respuesta exitosa se guarda en el store bajo `idem:<scope>:...`
+    con kind IDEMPOTENCY_KIND: vive lo que un pendiente (la vida del token de
+    Webpay, después el link ya no sirve) y no aparece en los índices ni en
+    las consultas de transacciones.
+    Los errores no se guardan, así un reintento vuelve a intentarlo. Una
+    respuesta con `token` se descarta apenas esa transacción termina sin
+    pago (rechazada, vencida o purgada): pedir de nuevo entrega un link nuevo
+    en vez del muerto.
+
+    Los duplicados concurrentes esperan al primero: en el mismo proceso con
+    SingleFlight; entre workers con `store.acquire_lock_or_wait`, consultando
+    la respuesta hasta que aparezca (igual que confirm_payment).
+    """
+
+    def __init__(self, store: TransactionStore, *, lock_ttl: float = 30.0):
+        self.store = store
+        self.lock_ttl = lock_ttl
+        self._inflight = SingleFlight()
+
+    async def run(
+        self,
+        scope: str,
+        key: str,
+        fn: Callable[[], Awaitable[dict]],
+        request_fingerprint: Optional[str] = None,
+    ) -> Tuple[dict, bool]:
+        """
+        La respuesta de `fn` para `key`, ejecutándola a lo más una vez por
+        vida de la clave. Devuelve (respuesta, True si es repetida). Con
+        `request_fingerprint`, una respuesta guardada para otro cuerpo
+        levanta IdempotencyMismatch.
+        """
+        store_key = idempotency_key(scope, key)
+        # SingleFlight comparte el resultado con todos los que esperaban: el
+        # único que no recibe una repetición es quien ejecutó `fn`
+        first = []
+        response, fp = await self._inflight.do(
+            store_key, lambda: self._run(store_key, fn, request_fingerprint, first)
+        )
+        if request_fingerprint is not None and fp is not None and fp != request_fingerprint:
+            raise IdempotencyMismatch(key)
+        replayed = not first
+        metrics.IDEMPOTENT_REQUESTS.labels(scope, "replayed" if replayed else "executed").inc()
+        return response, replayed
+
+    async def _cached(self, store_key: str) -> Optional[Tuple[dict, Optional[str]]]:
+        record = await self.store.get(store_key)
+        if record is None:
+            return None
+        response = record["response"]
+        token = response.get("token") if isinstance(response, dict) else None
+        if token is not None:
+            payment = await self.store.get(token)
+            if payment is None or payment.get("status") not in LIVE_STATUSES:
+                await self.store.delete(store_key)
+                return None
+        return response, record.get("fingerprint")
+
+    async def _run(self, store_key, fn, request_fingerprint, first):
+        cached = await self._cached(store_key)
+        if cached is not None:
+            return cached
+
+        lock_name = f"idempotency:{store_key}"
+        owner, cached = await self.store.acquire_lock_or_wait(
+            lock_name, self.lock_ttl, lambda: self._cached(store_key)
+        )
+        if cached is not None:
+            return cached
+
+        try:
+            # Pudo haber terminado mientras esperábamos el lock
+            cached = await self._cached(store_key)
+            if cached is not None:
+                return cached
+            response = await fn()
+            first.append(True)
+            await self.store.set(store_key, {
+                "kind": IDEMPOTENCY_KIND,
+                "response": response,
+                "fingerprint": request_fingerprint,
+                "created_at": time.time(),
+            })
+            return response, request_fingerprint
+        finally:
+            if owner is not None:
+                await self.store.release_lock(lock_name, owner)
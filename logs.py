@@ -0,0 +1,112 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+import metrics
+
+# Atributos propios de LogRecord; todo lo demás viene de `extra=` y va al JSON
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "sample"}
+
+
+class JSONFormatter(logging.Formatter):
+    """Una línea JSON por evento, con los campos de `extra=` al mismo nivel."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+            + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Deja pasar sólo una fracción de los mensajes marcados como de alto
+    volumen: `logger.info(..., extra={"sample": 0.01})` emite ~1 de cada 100.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = getattr(record, "sample", None)
+        return rate is None or random.random() < rate
+
+
+class _SampleRate(logging.Filter):
+    """Marca todos los eventos de un logger con una tasa de muestreo fija."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.sample = self.rate
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Encola el LogRecord tal cual, sin formatearlo: el `%` del mensaje y el
+    JSON se arman en el thread escritor. Si la cola está llena el evento se
+    descarta (y se cuenta en log_records_dropped_total) en vez de bloquear
+    al request.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.LOG_RECORDS_DROPPED.inc()
+
+
+_listener = None
+
+
+def setup_logging() -> None:
+    """
+    Configura el logging del proceso: nivel por LOG_LEVEL, cola acotada por
+    LOG_QUEUE_SIZE y un thread que escribe JSON en stdout. Idempotente.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    log_queue = queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", 10000)))
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JSONFormatter())
+    _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+    # Los logs de uvicorn (incluido el access log, el de mayor volumen) pasan
+    # por la misma cola en vez de escribir directo a stdout
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers[:] = []
+        uvicorn_logger.propagate = True
+    # httpx registra cada request saliente en INFO: sólo interesan sus avisos
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    access_sample = float(os.getenv("ACCESS_LOG_SAMPLE", 1.0))
+    if access_sample < 1.0:
+        logging.getLogger("uvicorn.access").addFilter(_SampleRate(access_sample))
@@ -1,29 +1,175 @@
+import asyncio
+import base64
+import binascii
+import hmac
+import json
+import logging
+import math
 import os
 import time
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import List, Optional
+from typing import List, Optional, Tuple, Union
 
-import requests
-from fastapi import FastAPI, HTTPException
+import httpx
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from dotenv import load_dotenv
-import mercadopago
 
+# Antes de importar los módulos propios: algunos leen variables de entorno al
+# importarse (PROMETHEUS_MULTIPROC_DIR, WORKER_ID)
 load_dotenv()
 
-app = FastAPI()
+import metrics
+from cache import TTLCache
+from catalog import CatalogSource, PrecomputedJSON, PriceIndex, etag_matches
+from events import TransactionEvents, is_final
+from idempotency import IdempotencyMismatch, IdempotentRequests, fingerprint
+from ids import new_buy_order, new_id
+from logs import setup_logging
+from mp_client import (
+    MP_API_BASE_URL,
+    MercadoPagoClient,
+    MercadoPagoError,
+    MercadoPagoUnavailable,
+    valid_payment_id,
+)
+from mp_notifications import MPNotificationProcessor, payment_id_from_notification
+from outbox import Outbox, OutboxDispatcher
+from reconcile import ReconciliationSweeper
+from singleflight import SingleFlight
+from slots import SlotConflict, SlotIndex, free_slots, parse_time, service_key
+from store import create_store, maintenance_loop
+from transbank import TransbankClient, TransbankError, TransbankUnavailable
+
+logger = logging.getLogger(__name__)
+
+setup_logging()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Cliente compartido: un pool keep-alive hacia Transbank para todo el proceso
+    app.state.transbank = TransbankClient(
+        WEBPAY_CONFIG["commerce_code"],
+        WEBPAY_CONFIG["api_key"],
+        WEBPAY_CONFIG["base_url"],
+        timeout=float(os.getenv("WEBPAY_TIMEOUT", 30)),
+        min_timeout=float(os.getenv("WEBPAY_TIMEOUT_MIN", 2)),
+        timeout_factor=float(os.getenv("WEBPAY_TIMEOUT_FACTOR", 3)),
+        breaker_failures=int(os.getenv("WEBPAY_BREAKER_FAILURES", 5)),
+        breaker_reset=float(os.getenv("WEBPAY_BREAKER_RESET", 30)),
+        max_connections=int(os.getenv("WEBPAY_MAX_CONNECTIONS", 100)),
+    )
+    app.state.store = create_store()
+    # WAL + snapshots del store en memoria (TRANSACTION_WAL_DIR)
+    persistencia = asyncio.create_task(app.state.store.run())
+    mantenimiento = asyncio.create_task(
+        maintenance_loop(app.state.store, float(os.getenv("TRANSACTION_PURGE_INTERVAL", 30)))
+    )
+    # Cambios de estado para SSE / long-poll (con Redis, de todos los workers)
+    app.state.events = TransactionEvents(
+        app.state.store, poll_interval=float(os.getenv("TRANSACTION_EVENTS_POLL_INTERVAL", 2))
+    )
+    cambios = asyncio.create_task(app.state.store.listen())
+    # Horarios retenidos/pagados por servicio, para rechazar reservas cruzadas.
+    # El hold vence un poco antes que el pendiente en el store, para poder
+    # revisarlo contra Transbank y avisar a n8n mientras el registro existe.
+    pending_ttl = app.state.store.policy.pending_ttl
+    pending_window = pending_ttl - min(30, pending_ttl / 10)
+    app.state.slots = SlotIndex(
+        hold_ttl=pending_window,
+        on_expire=lambda token: _hold_vencido(token, app),
+        retry_interval=float(os.getenv("RECONCILE_INTERVAL", 60)),
+    )
+    app.state.store.add_listener(app.state.slots.observe)
+    await app.state.slots.rebuild(app.state.store)
+    # Reintentos de n8n: la primera respuesta se reutiliza (ver idempotency.py)
+    app.state.idempotency = IdempotentRequests(
+        app.state.store, lock_ttl=float(os.getenv("IDEMPOTENCY_LOCK_TTL", 30))
+    )
+    # Avisos a n8n: outbox durable + dispatcher en segundo plano
+    app.state.outbox = Outbox(os.getenv("OUTBOX_PATH", "outbox.db"))
+    app.state.n8n_client = httpx.AsyncClient()
+    app.state.dispatcher = OutboxDispatcher(
+        app.state.outbox,
+        app.state.n8n_client,
+        concurrency=int(os.getenv("N8N_CONCURRENCY", 8)),
+        max_attempts=int(os.getenv("N8N_MAX_ATTEMPTS", 10)),
+        timeout=float(os.getenv("N8N_TIMEOUT", 10)),
+        upstream="n8n_webhook",
+    )
+    dispatcher = asyncio.create_task(app.state.dispatcher.run())
+    # MercadoPago: un pool keep-alive para las rutas y las notificaciones
+    app.state.mp_client = MercadoPagoClient(
+        MP_ACCESS_TOKEN,
+        os.getenv("MP_API_BASE_URL", MP_API_BASE_URL),
+        timeout=float(os.getenv("MP_TIMEOUT", 10)),
+        connect_timeout=float(os.getenv("MP_CONNECT_TIMEOUT", 3)),
+        retries=int(os.getenv("MP_RETRIES", 2)),
+    )
+    # Notificaciones de MercadoPago: cola en memoria + workers
+    app.state.mp_notifications = MPNotificationProcessor(
+        app.state.mp_client,
+        app.state.store,
+        workers=int(os.getenv("MP_NOTIFICATION_WORKERS", 4)),
+        payment_cache=mp_payment_cache,
+    )
+    notificaciones_mp = asyncio.create_task(app.state.mp_notifications.run())
+    # Conciliación de pendientes cuyo usuario no volvió de Webpay
+    app.state.sweeper = ReconciliationSweeper(
+        app.state.store,
+        app.state.transbank,
+        lambda token, record, result: _conciliar_pendiente(token, record, result, app),
+        older_than=float(os.getenv("RECONCILE_AFTER", 360)),
+        interval=float(os.getenv("RECONCILE_INTERVAL", 60)),
+        concurrency=int(os.getenv("RECONCILE_CONCURRENCY", 10)),
+        page_size=int(os.getenv("RECONCILE_PAGE_SIZE", 500)),
+        lock_ttl=CONFIRM_LOCK_TTL,
+        # Un INITIALIZED se deja pendiente hasta que vence su hold
+        pending_window=pending_window,
+    )
+    conciliacion = asyncio.create_task(app.state.sweeper.run())
+    # Vencimiento de holds de horario (usa el sweeper y el outbox)
+    horarios = asyncio.create_task(app.state.slots.run())
+    try:
+        yield
+    finally:
+        mantenimiento.cancel()
+        persistencia.cancel()
+        cambios.cancel()
+        notificaciones_mp.cancel()
+        conciliacion.cancel()
+        horarios.cancel()
+        dispatcher.cancel()
+        await app.state.dispatcher.stop()
+        await app.state.n8n_client.aclose()
+        await app.state.mp_client.aclose()
+        await app.state.outbox.close()
+        await app.state.transbank.aclose()
+        await app.state.store.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 PORT = int(os.getenv("PORT", 3000))
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:5173").rstrip("/")
 BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:3000")
 
-print(f"DEBUG: FRONTEND_URL loaded: {FRONTEND_URL}")
+logger.debug("FRONTEND_URL loaded: %s", FRONTEND_URL)
 
 @app.get("/")
 def read_root():
     return {"status": "Backend running successfully", "docs": "/docs"}
 
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
 # ================== CORS ==================
 raw_origins = os.getenv("ALLOWED_ORIGINS", "")
 if raw_origins == "*" or not raw_origins:
@@ -31,7 +177,7 @@ if raw_origins == "*" or not raw_origins:
 else:
     ALLOWED_ORIGINS = [o.strip() for o in raw_origins.replace("\n", ",").split(",") if o.strip()]
 
-print(f"DEBUG: ALLOWED_ORIGINS loaded: {ALLOWED_ORIGINS}")
+logger.debug("ALLOWED_ORIGINS loaded: %s", ALLOWED_ORIGINS)
 
 app.add_middleware(
     CORSMiddleware,
@@ -41,20 +187,22 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Latencia, códigos de estado y requests en curso por ruta (ver /metrics)
+app.add_middleware(metrics.MetricsMiddleware)
+
 # ================== Modelos de datos para n8n ==================
 class ReservationPaymentRequest(BaseModel):
     name: str
     email: str
     start_time: str  # ISO format
     end_time: str    # ISO format
-    amount: int
+    amount: Optional[int] = None  # Con catálogo de servicios se ignora
     service_name: str
+    service_id: Optional[Union[int, str]] = None
     phone: Optional[str] = None # Nuevo campo para WhatsApp
 
 # ================== MERCADOPAGO ==================
-mp_sdk = mercadopago.SDK(
-    os.getenv("MP_ACCESS_TOKEN", "TEST-...")
-)
+MP_ACCESS_TOKEN = os.getenv("MP_ACCESS_TOKEN", "TEST-...")
 
 # ================== WEBPAY ==================
 WEBPAY_CONFIG = {
@@ -63,7 +211,8 @@ WEBPAY_CONFIG = {
         "WEBPAY_API_KEY",
         "579B532A7440BB0C9079DED94D31EA1615BACEB56610332264630D42D0A36B1C"
     ),
-    "base_url": (
+    # WEBPAY_BASE_URL permite apuntar a un mock (ver bench/)
+    "base_url": os.getenv("WEBPAY_BASE_URL") or (
         "https://webpay3g.transbank.cl"
         if os.getenv("WEBPAY_ENVIRONMENT") == "LIVE"
         else "https://webpay3gint.transbank.cl"
@@ -76,11 +225,21 @@ products = [
     {"id": 2, "name": "Cactus", "price": 7000},
 ]
 
-transactions = {}
+# Servicios que se reservan por n8n: [{"id", "name", "price"}] en SERVICES_FILE.
+# Sólo sin catálogo (ni archivo ni lista) se cobra el `amount` que manda n8n.
+services = []
+
+# Las transacciones viven en app.state.store (ver store.py / TRANSACTION_STORE)
 
 # ================== MODELS ==================
+class OrderItem(BaseModel):
+    id: Union[int, str]
+    quantity: int = 1
+
+
 class CreatePaymentRequest(BaseModel):
-    amount: int
+    amount: Optional[int] = None
+    items: Optional[List[OrderItem]] = None  # Con items el monto sale del catálogo
 
 
 class ConfirmPaymentRequest(BaseModel):
@@ -88,8 +247,9 @@ class ConfirmPaymentRequest(BaseModel):
 
 
 class MPItem(BaseModel):
-    name: str
-    price: float
+    id: Optional[Union[int, str]] = None  # Con id, nombre y precio salen del catálogo
+    name: Optional[str] = None
+    price: Optional[float] = None
     quantity: Optional[int] = 1
 
 
@@ -98,51 +258,114 @@ class MPPreferenceRequest(BaseModel):
 
 
 # ================== ROUTES ==================
+# La respuesta se serializa una vez por versión del catálogo (PRODUCTS_FILE
+# o la lista de arriba) y se sirve con ETag para responder 304 sin cuerpo.
+products_source = CatalogSource(os.getenv("PRODUCTS_FILE"), products)
+products_response = PrecomputedJSON(products_source)
+# Precios por id/nombre, reconstruidos sólo cuando el archivo cambia
+product_prices = PriceIndex(products_source)
+service_prices = PriceIndex(CatalogSource(os.getenv("SERVICES_FILE"), services))
+PRODUCTS_CACHE_CONTROL = (
+    f"public, max-age={int(os.getenv('PRODUCTS_MAX_AGE', 60))}, "
+    f"stale-while-revalidate={int(os.getenv('PRODUCTS_STALE_WHILE_REVALIDATE', 86400))}"
+)
+
+
 @app.get("/api/products")
-def get_products():
-    return products
+async def get_products(request: Request):
+    body, etag = products_response.current()
+    headers = {"ETag": etag, "Cache-Control": PRODUCTS_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 # ========== WEBPAY ==========
 
-@app.post("/api/create-payment")
-def create_payment(data: CreatePaymentRequest):
-    if data.amount <= 0:
-        raise HTTPException(status_code=400, detail="Monto inválido")
+def _transbank_no_disponible(e: TransbankUnavailable) -> HTTPException:
+    # 503 + Retry-After: el cliente sabe que es transitorio y cuándo reintentar
+    return HTTPException(
+        status_code=503,
+        detail="Transbank no disponible, intenta nuevamente en unos momentos",
+        headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))},
+    )
 
-    buy_order = f"ORDER{int(time.time())}"
-    session_id = f"SESS{int(time.time())}"
-    return_url = f"{FRONTEND_URL}/payment-result"
 
-    payload = {
-        "buy_order": buy_order,
-        "session_id": session_id,
-        "amount": data.amount,
-        "return_url": return_url,
-    }
+# Sin header Idempotency-Key, las reservas usan una clave derivada del
+# cliente, el horario y el servicio (IDEMPOTENCY_DERIVED_KEYS=0 lo apaga)
+IDEMPOTENCY_DERIVED_KEYS = os.getenv("IDEMPOTENCY_DERIVED_KEYS", "1") != "0"
 
-    url = f"{WEBPAY_CONFIG['base_url']}/rswebpaytransaction/api/webpay/v1.2/transactions"
 
-    headers = {
-        "Tbk-Api-Key-Id": WEBPAY_CONFIG["commerce_code"],
-        "Tbk-Api-Key-Secret": WEBPAY_CONFIG["api_key"],
-        "Content-Type": "application/json",
-        "Date": datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT"),
-    }
+async def _idempotente(
+    app: FastAPI,
+    scope: str,
+    key: Optional[str],
+    fn,
+    request_fingerprint: Optional[str] = None,
+    response: Optional[Response] = None,
+) -> dict:
+    if not key:
+        return await fn()
+    try:
+        result, replayed = await app.state.idempotency.run(scope, key, fn, request_fingerprint)
+    except IdempotencyMismatch:
+        raise HTTPException(status_code=422, detail="Idempotency-Key ya usada con otros datos")
+    if replayed and response is not None:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
 
-    response = requests.post(url, json=payload, headers=headers)
 
-    if response.status_code != 200:
-        raise HTTPException(status_code=500, detail=response.text)
+@app.post("/api/create-payment")
+async def create_payment(data: CreatePaymentRequest, request: Request, response: Response):
+    key = request.headers.get("idempotency-key")
+    return await _idempotente(
+        request.app, "payment", key, lambda: _crear_pago(data, request.app),
+        fingerprint(data.dict()), response,
+    )
+
+
+def _monto_pedido(data: CreatePaymentRequest) -> int:
+    """Total de los items según el catálogo de productos, o el `amount` recibido."""
+    if not data.items:
+        if data.amount is None or data.amount <= 0:
+            raise HTTPException(status_code=400, detail="Monto inválido")
+        return data.amount
+    total = 0
+    for item in data.items:
+        product = product_prices.lookup(id=item.id)
+        if product is None:
+            raise HTTPException(status_code=400, detail=f"Producto desconocido: {item.id}")
+        if item.quantity <= 0:
+            raise HTTPException(status_code=400, detail="Cantidad inválida")
+        total += product["price"] * item.quantity
+    return total
+
 
-    resp_data = response.json()
+async def _crear_pago(data: CreatePaymentRequest, app: FastAPI) -> dict:
+    amount = _monto_pedido(data)
 
-    transactions[resp_data["token"]] = {
+    buy_order = new_buy_order("ORDER")
+    session_id = new_id("SESS")
+    return_url = f"{FRONTEND_URL}/payment-result"
+
+    try:
+        resp_data = await app.state.transbank.create_transaction(
+            buy_order, session_id, amount, return_url
+        )
+    except TransbankError as e:
+        raise HTTPException(status_code=500, detail=e.text)
+    except TransbankUnavailable as e:
+        raise _transbank_no_disponible(e)
+
+    record = {
         "status": "pending",
-        "amount": payload["amount"],
+        "amount": amount,
         "buy_order": buy_order,
-        "created_at": datetime.utcnow(),
+        "created_at": time.time(),
     }
+    if data.items:
+        record["items"] = [item.dict() for item in data.items]
+    await app.state.store.set(resp_data["token"], record)
 
     return {
         "success": True,
@@ -153,23 +376,23 @@ def create_payment(data: CreatePaymentRequest):
 
 
 # ========== MERCADOPAGO ==========
+
+def _error_mp(e: Exception) -> HTTPException:
+    if isinstance(e, MercadoPagoUnavailable):
+        return HTTPException(status_code=503, detail=str(e))
+    logger.error("Error MercadoPago: %s", e.text, extra={"status_code": e.status_code})
+    # Un 404 (pago inexistente) se propaga; el resto es un error del upstream
+    status_code = e.status_code if e.status_code == 404 else 502
+    return HTTPException(status_code=status_code, detail=f"Error con MercadoPago: {e.text}")
+
+
 @app.post("/api/mp/create-preference")
-def create_mp_preference(data: MPPreferenceRequest):
+async def create_mp_preference(data: MPPreferenceRequest, request: Request):
     if not data.items:
         raise HTTPException(status_code=400, detail="Items requeridos")
 
     preference = {
-        "items": [
-            {
-                "title": item.name[:255],
-                "unit_price": item.price,
-                "quantity": item.quantity or 1,
-                "currency_id": "CLP",
-                "description": item.name[:255],
-                "category_id": "others",
-            }
-            for item in data.items
-        ],
+        "items": [_item_mp(item) for item in data.items],
         "back_urls": {
             "success": f"{FRONTEND_URL}/mp-payment-success",
             "failure": f"{FRONTEND_URL}/mp-payment-failure",
@@ -177,12 +400,14 @@ def create_mp_preference(data: MPPreferenceRequest):
         },
         "auto_return": "approved",
         "notification_url": f"{BACKEND_URL}/api/mp/notifications",
-        "external_reference": f"ORDER_MP_{int(time.time())}",
+        "external_reference": new_id("ORDER_MP_"),
         "payment_methods": {"installments": 1},
     }
 
-    result = mp_sdk.preference().create(preference)
-    response = result["response"]
+    try:
+        response = await request.app.state.mp_client.create_preference(preference)
+    except (MercadoPagoError, MercadoPagoUnavailable) as e:
+        raise _error_mp(e)
 
     return {
         "success": True,
@@ -192,66 +417,247 @@ def create_mp_preference(data: MPPreferenceRequest):
     }
 
 
+def _item_mp(item: MPItem) -> dict:
+    name, price = item.name, item.price
+    if item.id is not None:
+        product = product_prices.lookup(id=item.id)
+        if product is None:
+            raise HTTPException(status_code=400, detail=f"Producto desconocido: {item.id}")
+        name, price = product["name"], product["price"]
+    if not name or price is None or price <= 0:
+        raise HTTPException(status_code=400, detail="Item inválido")
+    return {
+        "title": name[:255],
+        "unit_price": price,
+        "quantity": item.quantity or 1,
+        "currency_id": "CLP",
+        "description": name[:255],
+        "category_id": "others",
+    }
+
+
+# El frontend consulta esta ruta en loop mientras espera la aprobación: los
+# pagos en estado final casi no cambian, los demás se refrescan seguido.
+MP_FINAL_STATUSES = {"approved", "rejected", "cancelled", "refunded", "charged_back"}
+MP_PAYMENT_TTL_FINAL = float(os.getenv("MP_PAYMENT_TTL_FINAL", 300))
+MP_PAYMENT_TTL_PENDING = float(os.getenv("MP_PAYMENT_TTL_PENDING", 2))
+
+
+def _ttl_pago_mp(payment) -> float:
+    # Respuestas de error (sin id) no se cachean
+    if not isinstance(payment, dict) or "id" not in payment:
+        return 0
+    if payment.get("status") in MP_FINAL_STATUSES:
+        return MP_PAYMENT_TTL_FINAL
+    return MP_PAYMENT_TTL_PENDING
+
+
+mp_payment_cache = TTLCache(
+    "mp_payment", int(os.getenv("MP_PAYMENT_CACHE_SIZE", 10000)), _ttl_pago_mp
+)
+
+
 @app.get("/api/mp/payment/{payment_id}")
-def get_mp_payment(payment_id: str):
-    result = mp_sdk.payment().get(payment_id)
+async def get_mp_payment(payment_id: str, request: Request):
+    if not valid_payment_id(payment_id):
+        raise HTTPException(status_code=400, detail="Id de pago inválido")
+    try:
+        payment = await mp_payment_cache.get_or_fetch(
+            payment_id, lambda: request.app.state.mp_client.get_payment(payment_id)
+        )
+    except (MercadoPagoError, MercadoPagoUnavailable) as e:
+        raise _error_mp(e)
     return {
         "success": True,
-        "payment": result["response"],
+        "payment": payment,
     }
 
+
+@app.post("/api/mp/notifications")
+async def mp_notification(request: Request):
+    """
+    Receptor de IPN/webhooks de MercadoPago: sólo encola el pago y responde.
+    La consulta a la API y el ledger los hace MPNotificationProcessor.
+    """
+    params = dict(request.query_params)
+    body = None
+    if "data.id" not in params and "id" not in params:
+        try:
+            body = await request.json()
+        except ValueError:
+            body = None
+
+    payment_id = payment_id_from_notification(params, body)
+    if payment_id is None:
+        # Otros tópicos (merchant_order, etc.): se aceptan para que MP no reintente
+        return {"received": True}
+
+    if not request.app.state.mp_notifications.submit(payment_id):
+        # Cola llena: un no-2xx hace que MercadoPago reintente más tarde
+        raise HTTPException(status_code=503, detail="Cola de notificaciones llena")
+    return {"received": True}
+
 # ========== RESERVACIONES N8N ==========
 
 # URL del Webhook de n8n (Configurar en .env)
 N8N_WEBHOOK_URL = os.getenv("N8N_CONFIRMATION_WEBHOOK", "https://tu-ngrok.ngrok-free.app/rest/webhooks/reserva-confirmada")
+# Webhook aparte para las reservas que vencen sin pago (opcional: sin él no se avisa)
+N8N_EXPIRED_WEBHOOK_URL = os.getenv("N8N_EXPIRED_WEBHOOK")
+
+
+def _clave_reserva(data: ReservationPaymentRequest) -> Optional[str]:
+    """Clave derivada: el mismo cliente, horario y servicio es el mismo link."""
+    if not IDEMPOTENCY_DERIVED_KEYS:
+        return None
+    return "|".join((
+        data.name.strip().lower(),
+        data.email.strip().lower(),
+        data.start_time.strip(),
+        data.service_name.strip().lower(),
+    ))
+
 
 @app.post("/api/reserva/crear-pago")
-def crear_pago_reserva(data: ReservationPaymentRequest):
-    print("-----------------------------------------")
-    print(f"RECIBIENDO PETICIÓN DE N8N PARA: {data.name}")
-    print(f"DATOS: {data.dict()}")
-    print("-----------------------------------------")
-
-    buy_order = f"RES{int(time.time())}"
-    session_id = f"SESS{int(time.time())}"
-    return_url = f"{FRONTEND_URL}/payment-result"
+async def crear_pago_reserva(data: ReservationPaymentRequest, request: Request, response: Response):
+    key = request.headers.get("idempotency-key")
+    # Con clave derivada el cuerpo puede variar (p. ej. el teléfono) sin ser otra reserva
+    request_fingerprint = fingerprint(data.dict()) if key else None
+    return await _idempotente(
+        request.app, "reserva", key or _clave_reserva(data),
+        lambda: _crear_pago_reserva(data, request.app), request_fingerprint, response,
+    )
 
-    payload = {
-        "buy_order": buy_order,
-        "session_id": session_id,
-        "amount": data.amount,
-        "return_url": return_url,
-    }
 
-    url = f"{WEBPAY_CONFIG['base_url']}/rswebpaytransaction/api/webpay/v1.2/transactions"
-    headers = {
-        "Tbk-Api-Key-Id": WEBPAY_CONFIG["commerce_code"],
-        "Tbk-Api-Key-Secret": WEBPAY_CONFIG["api_key"],
-        "Content-Type": "application/json",
-        "Date": datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT"),
-    }
+# Reservas que se cruzan con otra pendiente o pagada del mismo servicio: 409
+# antes de llamar a Transbank (RESERVA_CHECK_OVERLAP=0 lo apaga)
+RESERVA_CHECK_OVERLAP = os.getenv("RESERVA_CHECK_OVERLAP", "1") != "0"
+# Respaldo: el claim se libera al terminar el request
+RESERVA_CLAIM_TTL = 2 * float(os.getenv("WEBPAY_TIMEOUT", 30))
+
+
+def _horario_ocupado(data: ReservationPaymentRequest) -> HTTPException:
+    metrics.RESERVATION_CONFLICTS.inc()
+    logger.info(
+        "Horario ocupado: %s %s-%s", data.service_name, data.start_time, data.end_time,
+        extra={"service": data.service_name},
+    )
+    return HTTPException(status_code=409, detail="El horario ya está reservado")
+
+
+async def _retener_horario(
+    data: ReservationPaymentRequest, app: FastAPI
+) -> Optional[Tuple[str, Optional[str]]]:
+    """
+    (claim del índice, claim del store) del horario pedido. El del store sólo
+    existe si el backend no reparte los cambios entre workers (SQLite): ahí
+    el índice del proceso no ve las reservas de los demás.
+    """
+    if not RESERVA_CHECK_OVERLAP:
+        return None
+    start, end = parse_time(data.start_time), parse_time(data.end_time)
+    if start is None or end is None or end <= start:
+        raise HTTPException(status_code=400, detail="Horario inválido")
+    try:
+        claim = app.state.slots.claim(data.service_name, start, end, RESERVA_CLAIM_TTL)
+    except SlotConflict:
+        raise _horario_ocupado(data)
+    if app.state.store.broadcasts_changes:
+        return claim, None
+    try:
+        store_claim = await app.state.store.claim_slot(
+            service_key(data.service_name), start, end, RESERVA_CLAIM_TTL, app.state.slots.hold_ttl
+        )
+    except BaseException:
+        app.state.slots.remove(claim)
+        raise
+    if store_claim is None:
+        app.state.slots.remove(claim)
+        raise _horario_ocupado(data)
+    return claim, store_claim
 
-    response = requests.post(url, json=payload, headers=headers)
-    
-    if response.status_code != 200:
-        print(f"ERROR TRANSBANK: {response.text}")
-        raise HTTPException(status_code=response.status_code, detail=f"Error con Transbank: {response.text}")
 
-    resp_data = response.json()
+def _precio_reserva(data: ReservationPaymentRequest) -> ReservationPaymentRequest:
+    """
+    La reserva con el precio y el nombre del servicio según el catálogo
+    (SERVICES_FILE); sólo sin catálogo configurado se usa el `amount` recibido.
+    Un catálogo configurado pero vacío (archivo ausente, ilegible o sin
+    precios válidos) rechaza la reserva: no se cobra lo que diga n8n.
+    """
+    if not service_prices.source.configured:
+        if data.amount is None or data.amount <= 0:
+            raise HTTPException(status_code=400, detail="Monto inválido")
+        return data
+    if not len(service_prices):
+        logger.error("Catálogo de servicios vacío o ilegible: se rechaza la reserva")
+        raise HTTPException(status_code=503, detail="Catálogo de servicios no disponible")
+    service = service_prices.lookup(id=data.service_id, name=data.service_name)
+    if service is None:
+        raise HTTPException(
+            status_code=400, detail=f"Servicio desconocido: {data.service_id or data.service_name}"
+        )
+    if data.amount is not None and data.amount != service["price"]:
+        logger.warning(
+            "Monto de n8n (%d) distinto del catálogo (%d) para %s",
+            data.amount, service["price"], service["name"], extra={"service": service["name"]},
+        )
+    return data.model_copy(update={"amount": service["price"], "service_name": service["name"]})
+
+
+async def _crear_pago_reserva(data: ReservationPaymentRequest, app: FastAPI) -> dict:
+    data = _precio_reserva(data)
+    # El claim retiene el horario mientras se crea la transacción; después lo
+    # retiene el token (observe) y el claim se suelta
+    claims = await _retener_horario(data, app)
+    try:
+        return await _crear_link_reserva(data, app)
+    finally:
+        if claims is not None:
+            claim, store_claim = claims
+            app.state.slots.remove(claim)
+            if store_claim is not None:
+                await app.state.store.release_slot(store_claim)
+
+
+async def _crear_link_reserva(data: ReservationPaymentRequest, app: FastAPI) -> dict:
+    logger.info("Petición de n8n para: %s", data.name)
+    # data.dict() sólo se arma si DEBUG está activo
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Datos de la reserva: %s", data.dict())
+
+    buy_order = new_buy_order("RES")
+    session_id = new_id("SESS")
+    return_url = f"{FRONTEND_URL}/payment-result"
+
+    try:
+        resp_data = await app.state.transbank.create_transaction(
+            buy_order, session_id, data.amount, return_url
+        )
+    except TransbankError as e:
+        logger.error("Error Transbank: %s", e.text, extra={"status_code": e.status_code})
+        raise HTTPException(status_code=e.status_code, detail=f"Error con Transbank: {e.text}")
+    except TransbankUnavailable as e:
+        logger.warning("Transbank no disponible: %s", e)
+        raise _transbank_no_disponible(e)
 
     # Guardamos los datos de la reserva asociados al token
-    transactions[resp_data["token"]] = {
+    record = {
         "status": "pending",
         "reserva_data": data.dict(),
         "buy_order": buy_order,
         "amount": data.amount,
-        "created_at": datetime.utcnow()
+        "created_at": time.time()
     }
+    await app.state.store.set(resp_data["token"], record)
+    # Con Redis el evento propio llega por pub/sub: se indexa ya, antes de soltar el claim
+    app.state.slots.observe(resp_data["token"], record)
 
     # CONSTRUIMOS EL LINK FINAL AQUÍ PARA EL BOT
     # Agregamos el teléfono como parámetro de retorno para recuperarlo después si es necesario
     link_final = f"{resp_data['url']}?token_ws={resp_data['token']}"
-    print(f"LINK GENERADO PARA {data.name} ({data.phone or 'Sin teléfono'}): {link_final}")
+    logger.info(
+        "Link generado para %s (%s): %s", data.name, data.phone or "Sin teléfono", link_final,
+        extra={"token": resp_data["token"], "buy_order": buy_order},
+    )
 
     return {
         "success": True,
@@ -259,65 +665,251 @@ def crear_pago_reserva(data: ReservationPaymentRequest):
         "token": resp_data["token"]
     }
 
+
+RESERVA_BATCH_MAX = int(os.getenv("RESERVA_BATCH_MAX", 100))
+RESERVA_BATCH_CONCURRENCY = int(os.getenv("RESERVA_BATCH_CONCURRENCY", 8))
+
+
+@app.post("/api/reserva/crear-pago/batch")
+async def crear_pago_reserva_batch(data: List[ReservationPaymentRequest], request: Request):
+    """
+    Crea varios links de pago en un solo llamado (backlog de n8n). Las
+    transacciones se crean en paralelo, a lo más RESERVA_BATCH_CONCURRENCY a
+    la vez; los resultados vuelven en el mismo orden de la entrada y un error
+    en una reserva no afecta a las demás.
+    """
+    if len(data) > RESERVA_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"Máximo {RESERVA_BATCH_MAX} reservas por lote")
+
+    cupos = asyncio.Semaphore(RESERVA_BATCH_CONCURRENCY)
+
+    async def crear(index: int, reserva: ReservationPaymentRequest) -> dict:
+        async with cupos:
+            try:
+                result = await _idempotente(
+                    request.app, "reserva", _clave_reserva(reserva),
+                    lambda: _crear_pago_reserva(reserva, request.app),
+                )
+                return {"index": index, **result}
+            except HTTPException as e:
+                return {"index": index, "success": False, "status_code": e.status_code, "error": e.detail}
+            except Exception as e:
+                logger.exception("Error en lote (reserva %d)", index)
+                return {"index": index, "success": False, "status_code": 500, "error": str(e)}
+
+    results = await asyncio.gather(*(crear(i, reserva) for i, reserva in enumerate(data)))
+    return {
+        "success": all(r["success"] for r in results),
+        "results": results,
+    }
+
+
+# Rango máximo de una consulta de disponibilidad
+AVAILABILITY_MAX_DAYS = 31
+
+
+def _fecha_reserva(valor: str) -> datetime:
+    try:
+        return datetime.fromisoformat(valor.strip().replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Fecha inválida: {valor}")
+
+
+@app.get("/api/reserva/availability")
+async def reserva_availability(
+    request: Request,
+    service: str,
+    desde: str = Query(..., alias="from"),
+    hasta: str = Query(..., alias="to"),
+    slot: int = 60,
+):
+    """
+    Bloques libres de `slot` minutos de un servicio en [from, to), alineados
+    desde `from`, según las reservas pendientes y pagadas que conoce el
+    backend. Las horas vuelven en la zona horaria de `from` (sin zona si
+    `from` no la trae), listas para `/api/reserva/crear-pago`.
+    """
+    inicio, fin = _fecha_reserva(desde), _fecha_reserva(hasta)
+    start, end = inicio.timestamp(), fin.timestamp()
+    if slot <= 0 or end <= start:
+        raise HTTPException(status_code=400, detail="Rango u horario inválido")
+    if end - start > AVAILABILITY_MAX_DAYS * 86400:
+        raise HTTPException(status_code=400, detail=f"Máximo {AVAILABILITY_MAX_DAYS} días por consulta")
+
+    length = slot * 60
+    busy = request.app.state.slots.busy(service, start, end)
+
+    def hora(t: float) -> str:
+        return datetime.fromtimestamp(t, inicio.tzinfo).isoformat()
+
+    return {
+        "service": service,
+        "from": hora(start),
+        "to": hora(end),
+        "slot_minutes": slot,
+        "slots": [
+            {"start_time": hora(t), "end_time": hora(t + length)}
+            for t in free_slots(busy, start, end, length)
+        ],
+        "busy": [{"start_time": hora(low), "end_time": hora(high)} for low, high in busy],
+    }
+
+
+def _aviso_reserva(status: str, token: str, record: dict) -> dict:
+    reserva = record["reserva_data"]
+    return {
+        "status": status,
+        "token": token,
+        "buy_order": record["buy_order"],
+        "nombre": reserva["name"],
+        "email": reserva["email"],
+        "startTime": reserva["start_time"],
+        "endTime": reserva["end_time"],
+        "service": reserva["service_name"],
+        "amount": record["amount"],
+        "from_number": reserva.get("phone", ""), # Devolvemos el teléfono para WA
+    }
+
+
+def _aviso_reserva_pagada(token: str, record: dict, result: dict) -> dict:
+    # Enviamos todo lo que Transbank nos dio
+    return {**_aviso_reserva("paid", token, record), "payment_details": result}
+
+# Un solo commit en vuelo por token: los llamados concurrentes (doble clic,
+# refresh, reintentos del frontend) esperan y comparten el resultado.
+confirmaciones = SingleFlight()
+CONFIRM_LOCK_TTL = float(os.getenv("CONFIRM_LOCK_TTL", 30))
+# Estados que todavía pasan por el commit: "expired" lo pone la conciliación
+# y el cliente puede volver de Webpay después (el pago sólo se captura así)
+CONFIRMABLE_STATUSES = {"pending", "expired"}
+
+
+def _respuesta_confirmacion(record: dict) -> dict:
+    return {
+        "success": record.get("status") == "AUTHORIZED",
+        "status": record.get("status"),
+        "details": record.get("details", {})
+    }
+
+
+async def _confirmacion_guardada(token: str, app: FastAPI) -> Optional[dict]:
+    """La respuesta ya registrada para el token, o None si todavía se puede confirmar."""
+    record = await app.state.store.get(token)
+    if record is not None and record.get("status") not in CONFIRMABLE_STATUSES:
+        return _respuesta_confirmacion(record)
+    return None
+
+
 @app.post("/api/confirm-payment")
-def confirm_payment(data: ConfirmPaymentRequest):
+async def confirm_payment(data: ConfirmPaymentRequest, request: Request):
     """
     Confirma el pago con Webpay y notifica a n8n si es una reserva.
     """
-    token = data.token
+    return await confirmaciones.do(data.token, lambda: _confirmar_pago(data.token, request.app))
+
+
+async def _registrar_resultado(token: str, record: Optional[dict], result: dict, app: FastAPI) -> None:
+    status = result.get("status")
+
+    # Si el pago fue autorizado y es una reserva, dejamos el aviso a n8n en el
+    # outbox ANTES de marcar el token: si el proceso cae entremedio, el aviso
+    # igual sale. El dispatcher lo entrega en segundo plano, con reintentos.
+    if record is not None and status == "AUTHORIZED" and record.get("reserva_data"):
+        await app.state.outbox.enqueue(
+            N8N_WEBHOOK_URL, _aviso_reserva_pagada(token, record, result)
+        )
+        app.state.dispatcher.wake()
+        logger.info(
+            "Notificación a n8n encolada para reserva: %s", record["reserva_data"]["name"],
+            extra={"token": token},
+        )
+
+    await app.state.store.update(token, {
+        "status": status,
+        "updated_at": time.time(),
+        "details": result,
+    })
+
 
-    # 1. Si ya tenemos el token en nuestro diccionario local y el estado NO es pendiente,
+async def _conciliar_pendiente(token: str, record: dict, result: Optional[dict], app: FastAPI) -> None:
+    """
+    Resultado del barrido de pendientes (o de un hold vencido): si Transbank
+    lo tiene autorizado se registra igual que en confirm_payment (con aviso a
+    n8n); si no, vence y, si es una reserva y hay N8N_EXPIRED_WEBHOOK, se
+    avisa a n8n para que el bot libere u ofrezca de nuevo el horario. Un
+    cliente que vuelve tarde de Webpay igual pasa por el commit (ver
+    _confirmar_pago).
+    """
+    if result is not None and result.get("status") == "AUTHORIZED":
+        logger.info("Pago recuperado por conciliación", extra={"token": token})
+        await _registrar_resultado(token, record, result, app)
+        return
+    if record.get("reserva_data"):
+        logger.info(
+            "Reserva vencida sin pago: %s", record["reserva_data"]["name"], extra={"token": token}
+        )
+        if N8N_EXPIRED_WEBHOOK_URL:
+            # Igual que el aviso de pago: al outbox antes de marcar el token
+            await app.state.outbox.enqueue(
+                N8N_EXPIRED_WEBHOOK_URL, _aviso_reserva("expired", token, record)
+            )
+            app.state.dispatcher.wake()
+    await app.state.store.update(token, {
+        "status": "expired",
+        "updated_at": time.time(),
+        "details": result or {},
+    })
+
+
+async def _hold_vencido(token: str, app: FastAPI) -> bool:
+    """
+    Venció el hold de una reserva todavía pendiente: se revisa contra
+    Transbank igual que en el barrido. False si Transbank no respondió o si
+    el token sigue abierto (el hold se reintenta más tarde).
+    """
+    return await app.state.sweeper.reconcile(token) not in ("unavailable", "error", "pending")
+
+
+async def _confirmar_pago(token: str, app: FastAPI) -> dict:
+    store = app.state.store
+
+    # 1. Si ya tenemos el token en el store con un resultado de Transbank,
     # significa que ya lo procesamos (posible doble clic o re-render).
-    if token in transactions and transactions[token].get("status") != "pending":
-        return {
-            "success": transactions[token].get("status") == "AUTHORIZED",
-            "status": transactions[token].get("status"),
-            "details": transactions[token].get("details", {})
-        }
-
-    url = f"{WEBPAY_CONFIG['base_url']}/rswebpaytransaction/api/webpay/v1.2/transactions/{token}"
-    headers = {
-        "Tbk-Api-Key-Id": WEBPAY_CONFIG["commerce_code"],
-        "Tbk-Api-Key-Secret": WEBPAY_CONFIG["api_key"],
-        "Content-Type": "application/json",
-        "Date": datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT"),
-    }
+    guardada = await _confirmacion_guardada(token, app)
+    if guardada is not None:
+        return guardada
 
-    response = requests.put(url, headers=headers)
-    
-    if response.status_code != 200:
-        # Si ya fue confirmada o el token es inválido
-        raise HTTPException(status_code=500, detail="Error al confirmar transacción")
+    # 2. Entre workers: el que toma el lock hace el commit; el resto espera a
+    # que el resultado aparezca en el store (o a que el lock quede libre).
+    lock_name = f"confirm:{token}"
+    owner, guardada = await store.acquire_lock_or_wait(
+        lock_name, CONFIRM_LOCK_TTL, lambda: _confirmacion_guardada(token, app)
+    )
+    if guardada is not None:
+        return guardada
 
-    result = response.json()
-    status = result.get("status")
+    try:
+        # Pudo haberse confirmado mientras esperábamos el lock
+        record = await store.get(token)
+        if record is not None and record.get("status") not in CONFIRMABLE_STATUSES:
+            return _respuesta_confirmacion(record)
 
-    if token in transactions:
-        transactions[token]["status"] = status
-        transactions[token]["updated_at"] = datetime.utcnow()
-        transactions[token]["details"] = result
-
-        # Si el pago fue autorizado y es una reserva, avisamos a n8n
-        if status == "AUTHORIZED":
-            reserva = transactions[token].get("reserva_data")
-            if reserva:
-                try:
-                    requests.post(N8N_WEBHOOK_URL, json={
-                        "status": "paid",
-                        "token": token,
-                        "buy_order": transactions[token]["buy_order"],
-                        "nombre": reserva["name"],
-                        "email": reserva["email"],
-                        "startTime": reserva["start_time"],
-                        "endTime": reserva["end_time"],
-                        "service": reserva["service_name"],
-                        "amount": transactions[token]["amount"],
-                        "from_number": reserva.get("phone", ""), # Devolvemos el teléfono para WA
-                        "payment_details": result # Enviamos todo lo que Transbank nos dio
-                    }, timeout=10)
-                    print(f"Notificación enviada a n8n para reserva: {reserva['name']}")
-                except Exception as e:
-                    print(f"Error avisando a n8n: {e}")
+        try:
+            result = await app.state.transbank.commit_transaction(token)
+        except TransbankError:
+            if record is not None and record.get("status") == "expired":
+                # Abandonado de verdad: Transbank ya no lo deja confirmar
+                return _respuesta_confirmacion(record)
+            # Si ya fue confirmada o el token es inválido
+            raise HTTPException(status_code=500, detail="Error al confirmar transacción")
+        except TransbankUnavailable as e:
+            raise _transbank_no_disponible(e)
+
+        status = result.get("status")
+        await _registrar_resultado(token, record, result, app)
+    finally:
+        if owner is not None:
+            await store.release_lock(lock_name, owner)
 
     return {
         "success": status == "AUTHORIZED",
@@ -325,4 +917,167 @@ def confirm_payment(data: ConfirmPaymentRequest):
         "details": result
     }
 
-print("BACKEND RUNNING - WEBPAY ENV:", os.getenv("WEBPAY_ENVIRONMENT", "INTEGRATION"))
\ No newline at end of file
+# ========== ESTADO EN VIVO ==========
+# En vez de llamar a confirm-payment o consultar en loop, el frontend y el bot
+# pueden quedarse escuchando el token y recibir el estado apenas cambia.
+TRANSACTION_EVENTS_HEARTBEAT = float(os.getenv("TRANSACTION_EVENTS_HEARTBEAT", 15))
+TRANSACTION_EVENTS_MAX_DURATION = float(os.getenv("TRANSACTION_EVENTS_MAX_DURATION", 600))
+TRANSACTION_WAIT_MAX = float(os.getenv("TRANSACTION_WAIT_MAX", 30))
+
+
+def _evento_sse(record: dict) -> str:
+    return f"event: status\ndata: {json.dumps(_respuesta_confirmacion(record))}\n\n"
+
+
+@app.get("/api/transactions/{token}/events")
+async def transaction_events(token: str, request: Request):
+    """
+    Server-Sent Events: envía el estado actual y cada cambio, y cierra al
+    llegar a un estado final (el cliente debe cerrar su EventSource ahí, o
+    el navegador reconecta). Entre cambios manda un comentario de heartbeat
+    para que proxies no corten la conexión.
+    """
+    store = request.app.state.store
+    events = request.app.state.events
+    if await store.get(token) is None:
+        raise HTTPException(status_code=404, detail="Transacción no encontrada")
+
+    async def stream():
+        # Suscritos antes de leer el estado: un cambio entremedio no se pierde
+        with events.subscribe(token) as queue:
+            record = await store.get(token)
+            if record is None:
+                return
+            yield "retry: 3000\n" + _evento_sse(record)
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + TRANSACTION_EVENTS_MAX_DURATION
+            while not is_final(record):
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return
+                change = await events.next_change(
+                    token, queue, record.get("status"), min(remaining, TRANSACTION_EVENTS_HEARTBEAT)
+                )
+                if change is None:
+                    yield ": ping\n\n"
+                else:
+                    record = change
+                    yield _evento_sse(record)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/api/transactions/{token}/wait")
+async def transaction_wait(
+    token: str, request: Request, status: Optional[str] = None, timeout: float = 25
+):
+    """
+    Long-poll: responde apenas el estado sea distinto de `status` (el último
+    que conoce el cliente) o, si no cambia en `timeout` segundos (máximo
+    TRANSACTION_WAIT_MAX), con el estado actual. Sin `status` responde de
+    inmediato.
+    """
+    events = request.app.state.events
+    with events.subscribe(token) as queue:
+        record = await request.app.state.store.get(token)
+        if record is None:
+            raise HTTPException(status_code=404, detail="Transacción no encontrada")
+        if record.get("status") == status:
+            change = await events.next_change(
+                token, queue, status, min(max(timeout, 0), TRANSACTION_WAIT_MAX)
+            )
+            if change is not None:
+                record = change
+    return {"token": token, **_respuesta_confirmacion(record)}
+
+# ========== ADMIN ==========
+# Consultas de soporte sobre el store por los índices secundarios (ver
+# INDEXED_FIELDS en store.py). Desactivado si ADMIN_TOKEN no está definido.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+ADMIN_PAGE_MAX = 500
+
+
+def _verificar_admin(request: Request) -> None:
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    authorization = request.headers.get("authorization", "")
+    if not hmac.compare_digest(authorization.encode(), f"Bearer {ADMIN_TOKEN}".encode()):
+        raise HTTPException(status_code=401, detail="No autorizado")
+
+
+def _instante(valor: Optional[str]) -> Optional[float]:
+    """Epoch en segundos o fecha ISO (`2024-05-01`, `2024-05-01T10:00:00-04:00`)."""
+    if valor is None:
+        return None
+    try:
+        return float(valor)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(valor).timestamp()
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Fecha inválida: {valor}")
+
+
+def _codificar_cursor(created_at: float, token: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([created_at, token]).encode()).decode()
+
+
+def _decodificar_cursor(cursor: str):
+    try:
+        created_at, token = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(created_at), str(token)
+    except (ValueError, TypeError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+
+@app.get("/api/admin/transactions", include_in_schema=False)
+async def admin_transactions(
+    request: Request,
+    buy_order: Optional[str] = None,
+    email: Optional[str] = None,
+    phone: Optional[str] = None,
+    status: Optional[str] = None,
+    desde: Optional[str] = Query(None, alias="from"),
+    hasta: Optional[str] = Query(None, alias="to"),
+    limit: int = 50,
+    cursor: Optional[str] = None,
+):
+    """
+    Transacciones por buy_order, email, teléfono o estado (a lo más un
+    filtro), opcionalmente en un rango de created_at [from, to), de la más
+    nueva a la más antigua. `next_cursor` pide la página siguiente.
+    """
+    _verificar_admin(request)
+    filtros = {
+        field: value
+        for field, value in (("buy_order", buy_order), ("email", email), ("phone", phone), ("status", status))
+        if value is not None
+    }
+    if len(filtros) > 1:
+        raise HTTPException(status_code=400, detail="Usar un solo filtro por consulta")
+    field, value = next(iter(filtros.items()), (None, None))
+
+    limit = max(1, min(limit, ADMIN_PAGE_MAX))
+    items = await request.app.state.store.query(
+        field,
+        value,
+        start=_instante(desde),
+        end=_instante(hasta),
+        before=_decodificar_cursor(cursor) if cursor else None,
+        limit=limit,
+    )
+    next_cursor = None
+    if len(items) == limit:
+        token, record = items[-1]
+        next_cursor = _codificar_cursor(record.get("created_at", 0.0), token)
+    return {
+        "items": [{"token": token, **record} for token, record in items],
+        "next_cursor": next_cursor,
+    }
+
+logger.info("Backend running - Webpay env: %s", os.getenv("WEBPAY_ENVIRONMENT", "INTEGRATION"))
\ No newline at end of file
@@ -0,0 +1,188 @@
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client import multiprocess
+
+# Con varios workers de uvicorn cada proceso tiene sus propios contadores.
+# Si PROMETHEUS_MULTIPROC_DIR está definido (y vacío al arrancar), cada
+# worker escribe sus métricas en archivos mmap de ese directorio y /metrics
+# las agrega: cualquier worker que atienda el scrape devuelve el total.
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# ================== HTTP (rutas propias) ==================
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Latencia de las rutas del backend",
+    ["method", "route"],
+    buckets=LATENCY_BUCKETS,
+)
+HTTP_REQUESTS = Counter(
+    "http_requests_total",
+    "Requests atendidos por ruta y código de estado",
+    ["method", "route", "status"],
+)
+HTTP_IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "Requests en curso",
+    ["method"],
+    multiprocess_mode="livesum",
+)
+
+# ================== UPSTREAMS ==================
+UPSTREAM_DURATION = Histogram(
+    "upstream_request_duration_seconds",
+    "Latencia de las llamadas salientes por upstream",
+    ["upstream"],
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_REQUESTS = Counter(
+    "upstream_requests_total",
+    "Llamadas salientes por upstream y resultado (ok, error)",
+    ["upstream", "outcome"],
+)
+
+# 0 = closed, 1 = half_open, 2 = open; entre workers se muestra el peor
+CIRCUIT_BREAKER_STATE = Gauge(
+    "circuit_breaker_state",
+    "Estado del circuit breaker por upstream (0 closed, 1 half_open, 2 open)",
+    ["name"],
+    multiprocess_mode="livemax",
+)
+UPSTREAM_TIMEOUT = Gauge(
+    "upstream_timeout_seconds",
+    "Timeout adaptativo vigente por upstream",
+    ["upstream"],
+    multiprocess_mode="livemax",
+)
+
+# ================== TRANSACCIONES ==================
+# Con un store compartido todos los workers ven el mismo valor: se toma el máximo
+TRANSACTIONS_ENTRIES = Gauge(
+    "transactions_entries",
+    "Transacciones guardadas en el store (incluye pendientes y finalizadas)",
+    multiprocess_mode="livemax",
+)
+TRANSACTIONS_BYTES = Gauge(
+    "transactions_bytes",
+    "Tamaño aproximado en bytes de las transacciones guardadas",
+    multiprocess_mode="livemax",
+)
+TRANSACTION_EVENT_SUBSCRIBERS = Gauge(
+    "transaction_event_subscribers",
+    "Conexiones SSE / long-poll esperando cambios de una transacción",
+    multiprocess_mode="livesum",
+)
+
+# ================== CONCILIACIÓN ==================
+RECONCILE_SWEEP_DURATION = Histogram(
+    "reconcile_sweep_duration_seconds",
+    "Duración de cada barrido de pendientes contra Transbank",
+    buckets=LATENCY_BUCKETS + (60, 120, 300),
+)
+RECONCILE_TRANSACTIONS = Counter(
+    "reconcile_transactions_total",
+    "Pendientes revisados por el barrido, por resultado "
+    "(authorized, expired, skipped, error, unavailable)",
+    ["result"],
+)
+
+# ================== IDEMPOTENCIA ==================
+IDEMPOTENT_REQUESTS = Counter(
+    "idempotent_requests_total",
+    "Requests con clave de idempotencia por resultado (executed, replayed)",
+    ["scope", "result"],
+)
+
+# ================== RESERVAS ==================
+RESERVATION_CONFLICTS = Counter(
+    "reservation_conflicts_total",
+    "Reservas rechazadas con 409 por cruzarse con otra pendiente o pagada",
+)
+RESERVATION_HOLDS_EXPIRED = Counter(
+    "reservation_holds_expired_total",
+    "Holds de horario que vencieron sin pago confirmado y se revisaron contra Transbank",
+)
+
+# ================== CACHES ==================
+CACHE_REQUESTS = Counter(
+    "cache_requests_total",
+    "Consultas a caches en memoria por resultado (hit, miss, coalesced)",
+    ["cache", "result"],
+)
+
+# ================== LOGGING ==================
+LOG_RECORDS_DROPPED = Counter(
+    "log_records_dropped_total",
+    "Eventos de log descartados porque la cola del escritor estaba llena",
+)
+
+
+@contextmanager
+def track_upstream(upstream: str):
+    """Mide una llamada saliente: `with track_upstream("transbank_create"): ...`"""
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        UPSTREAM_DURATION.labels(upstream).observe(time.perf_counter() - start)
+        UPSTREAM_REQUESTS.labels(upstream, outcome).inc()
+
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI que mide cada request HTTP. La ruta se etiqueta con su
+    plantilla (`/api/mp/payment/{payment_id}`), no con la URL concreta, para
+    no disparar la cardinalidad; lo que no calza con ninguna ruta va como
+    "unmatched".
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        in_flight = HTTP_IN_FLIGHT.labels(method)
+        in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            in_flight.dec()
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            HTTP_REQUEST_DURATION.labels(method, path).observe(time.perf_counter() - start)
+            HTTP_REQUESTS.labels(method, path, str(status_code)).inc()
+
+
+def render():
+    """Devuelve (cuerpo, content-type) en formato de exposición de Prometheus."""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
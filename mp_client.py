@@ -0,0 +1,108 @@
+import asyncio
+import random
+from typing import Optional
+
+import httpx
+
+from metrics import track_upstream
+
+MP_API_BASE_URL = "https://api.mercadopago.com"
+
+# Respuestas de una lectura que vale la pena reintentar
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+def valid_payment_id(payment_id: str) -> bool:
+    """Los ids de pago de MercadoPago son numéricos; cualquier otra cosa iría cruda al path."""
+    return payment_id.isascii() and payment_id.isdigit()
+
+
+class MercadoPagoError(Exception):
+    """Respuesta no exitosa de la API de MercadoPago."""
+
+    def __init__(self, status_code: int, text: str):
+        super().__init__(f"MercadoPago respondió {status_code}: {text}")
+        self.status_code = status_code
+        self.text = text
+
+
+class MercadoPagoUnavailable(Exception):
+    """MercadoPago no responde (timeout o error de red), agotados los reintentos."""
+
+
+class MercadoPagoClient:
+    """
+    Cliente async de la API REST de MercadoPago con pool keep-alive.
+
+    El SDK oficial abre una sesión de requests nueva en cada llamada; este
+    cliente reutiliza las conexiones durante toda la vida del proceso.
+
+    Cada llamada tiene un timeout total (`timeout`) además del de conexión.
+    Las lecturas (GET) se reintentan hasta `retries` veces ante timeouts,
+    errores de red, 429 y 5xx, con backoff exponencial y jitter; la creación
+    de preferencias no se reintenta (un reintento podría duplicarla).
+    """
+
+    def __init__(
+        self,
+        access_token: str,
+        base_url: str = MP_API_BASE_URL,
+        *,
+        timeout: float = 10.0,
+        connect_timeout: float = 3.0,
+        retries: int = 2,
+        retry_backoff: float = 0.2,
+        max_connections: int = 50,
+        max_keepalive_connections: int = 20,
+    ):
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            headers={"Authorization": f"Bearer {access_token}"},
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+            ),
+        )
+
+    async def _send(self, upstream: str, method: str, path: str, json: Optional[dict]) -> dict:
+        try:
+            with track_upstream(upstream):
+                # Los timeouts de httpx son por fase; wait_for acota el total
+                response = await asyncio.wait_for(
+                    self._client.request(method, path, json=json), self.timeout
+                )
+                if response.status_code >= 300:
+                    raise MercadoPagoError(response.status_code, response.text)
+        except (httpx.TransportError, asyncio.TimeoutError) as e:
+            raise MercadoPagoUnavailable(f"MercadoPago no responde ({type(e).__name__})") from e
+        return response.json()
+
+    async def _request(
+        self, upstream: str, method: str, path: str, json: Optional[dict] = None
+    ) -> dict:
+        attempts = 1 + (self.retries if method == "GET" else 0)
+        for attempt in range(attempts):
+            try:
+                return await self._send(upstream, method, path, json)
+            except MercadoPagoError as e:
+                if e.status_code not in RETRYABLE_STATUS or attempt == attempts - 1:
+                    raise
+            except MercadoPagoUnavailable:
+                if attempt == attempts - 1:
+                    raise
+            await asyncio.sleep(self.retry_backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    async def create_preference(self, preference: dict) -> dict:
+        return await self._request("mp_preference", "POST", "/checkout/preferences", json=preference)
+
+    async def get_payment(self, payment_id: str) -> dict:
+        if not valid_payment_id(payment_id):
+            raise ValueError(f"Id de pago inválido: {payment_id!r}")
+        return await self._request("mp_payment", "GET", f"/v1/payments/{payment_id}")
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
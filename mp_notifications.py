@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from cache import TTLCache
+from mp_client import MercadoPagoClient, valid_payment_id
+from store import LEDGER_KIND, TransactionStore
+
+logger = logging.getLogger(__name__)
+
+LEDGER_PREFIX = "mp:"
+
+
+def ledger_key(external_reference: str) -> str:
+    """Clave del ledger de MercadoPago dentro del store de transacciones."""
+    return f"{LEDGER_PREFIX}{external_reference}"
+
+
+class MPNotificationProcessor:
+    """
+    Procesa en segundo plano las notificaciones (IPN/webhooks) de MercadoPago.
+
+    El endpoint sólo encola el id del pago y responde. Los workers consultan
+    el pago a la API y actualizan el ledger, que vive en el store bajo
+    `mp:<external_reference>` (kind LEDGER_KIND: fuera de los índices de
+    Webpay, con retención propia), y el cache de GET /api/mp/payment/{id}.
+
+    MercadoPago repite notificaciones del mismo pago (reintentos, IPN y
+    webhook a la vez). Mientras un id está en cola las repeticiones se
+    descartan; si llega una mientras se está procesando, el id se vuelve a
+    encolar una vez al terminar, para no perder un cambio de estado.
+    """
+
+    def __init__(
+        self,
+        client: MercadoPagoClient,
+        store: TransactionStore,
+        *,
+        workers: int = 4,
+        maxsize: int = 10000,
+        payment_cache: Optional[TTLCache] = None,
+    ):
+        self.client = client
+        self.store = store
+        self.payment_cache = payment_cache
+        self.workers = workers
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._queued = set()
+        self._inflight = set()
+        self._dirty = set()
+
+    def submit(self, payment_id: str) -> bool:
+        """Encola un pago; False si la cola está llena."""
+        if payment_id in self._queued:
+            return True
+        if payment_id in self._inflight:
+            self._dirty.add(payment_id)
+            return True
+        try:
+            self._queue.put_nowait(payment_id)
+        except asyncio.QueueFull:
+            return False
+        self._queued.add(payment_id)
+        return True
+
+    async def _process(self, payment_id: str) -> None:
+        payment = await self.client.get_payment(payment_id)
+        # Dato recién traído: refresca lo que ve GET /api/mp/payment/{id}
+        if self.payment_cache is not None:
+            self.payment_cache.set(payment_id, payment)
+        external_reference = payment.get("external_reference")
+        if not external_reference:
+            return
+
+        key = ledger_key(external_reference)
+        current = await self.store.get(key)
+        last_updated = payment.get("date_last_updated")
+        # Notificaciones fuera de orden: no pisar un estado más nuevo
+        if (
+            current is not None
+            and current.get("payment_id") == payment.get("id")
+            and (current.get("date_last_updated") or "") >= (last_updated or "")
+        ):
+            return
+
+        now = time.time()
+        await self.store.set(key, {
+            "kind": LEDGER_KIND,
+            "gateway": "mercadopago",
+            "status": payment.get("status"),
+            "status_detail": payment.get("status_detail"),
+            "payment_id": payment.get("id"),
+            "external_reference": external_reference,
+            "amount": payment.get("transaction_amount"),
+            "date_last_updated": last_updated,
+            "created_at": current.get("created_at", now) if current else now,
+            "updated_at": now,
+        })
+        logger.info(
+            "Ledger MP %s: pago %s -> %s", external_reference, payment_id, payment.get("status")
+        )
+
+    async def _worker(self) -> None:
+        while True:
+            payment_id = await self._queue.get()
+            self._queued.discard(payment_id)
+            self._inflight.add(payment_id)
+            try:
+                await self._process(payment_id)
+            except Exception:
+                logger.exception("Error procesando notificación MP %s", payment_id)
+            finally:
+                self._inflight.discard(payment_id)
+                self._queue.task_done()
+                if payment_id in self._dirty:
+                    self._dirty.discard(payment_id)
+                    self.submit(payment_id)
+
+    async def run(self) -> None:
+        await asyncio.gather(*(self._worker() for _ in range(self.workers)))
+
+
+def payment_id_from_notification(params: dict, body: Optional[dict]) -> Optional[str]:
+    """
+    Extrae el id de pago de una notificación, en cualquiera de sus formatos:
+    IPN (`?topic=payment&id=`) o webhook (`?type=payment&data.id=` y cuerpo
+    `{"type": "payment", "data": {"id": ...}}`). Otros tópicos, o un id que
+    no es numérico (la notificación no viene autenticada), devuelven None.
+    """
+    body = body or {}
+    topic = params.get("topic") or params.get("type") or body.get("type") or body.get("topic")
+    if topic != "payment":
+        return None
+    payment_id = (
+        params.get("data.id")
+        or params.get("id")
+        or (body.get("data") or {}).get("id")
+    )
+    if not payment_id or not valid_payment_id(str(payment_id)):
+        return None
+    return str(payment_id)
@@ -0,0 +1,230 @@
+import asyncio
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+import httpx
+
+from metrics import track_upstream
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """
+    Cola durable (SQLite) de webhooks salientes.
+
+    Un mensaje se borra sólo cuando el destino respondió 2xx. Al tomarlo, el
+    dispatcher lo "arrienda" por `lease` segundos: si el proceso muere antes
+    de entregarlo, el arriendo vence y otro worker (o el próximo arranque) lo
+    vuelve a tomar. Semántica at-least-once: el receptor puede ver duplicados
+    y debe deduplicar por el header Idempotency-Key.
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " url TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " status TEXT NOT NULL DEFAULT 'pending',"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_attempt_at REAL NOT NULL,"
+            " locked_until REAL NOT NULL DEFAULT 0,"
+            " last_error TEXT,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)"
+        )
+
+    async def _run(self, fn, *args):
+        def locked():
+            with self._lock:
+                return fn(*args)
+
+        return await asyncio.to_thread(locked)
+
+    def _enqueue(self, url, payload):
+        now = time.time()
+        cursor = self._conn.execute(
+            "INSERT INTO outbox (url, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+            (url, json.dumps(payload), now, now),
+        )
+        return cursor.lastrowid
+
+    def _claim(self, limit, lease):
+        now = time.time()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self._conn.execute(
+                "SELECT id, url, payload, attempts FROM outbox"
+                " WHERE status = 'pending' AND next_attempt_at <= ? AND locked_until <= ?"
+                " ORDER BY next_attempt_at LIMIT ?",
+                (now, now, limit),
+            ).fetchall()
+            self._conn.executemany(
+                "UPDATE outbox SET locked_until = ? WHERE id = ?",
+                [(now + lease, row[0]) for row in rows],
+            )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return [
+            {"id": row[0], "url": row[1], "payload": json.loads(row[2]), "attempts": row[3]}
+            for row in rows
+        ]
+
+    def _delivered(self, message_id):
+        self._conn.execute("DELETE FROM outbox WHERE id = ?", (message_id,))
+
+    def _failed(self, message_id, attempts, next_attempt_at, error, dead):
+        self._conn.execute(
+            "UPDATE outbox SET attempts = ?, next_attempt_at = ?, locked_until = 0,"
+            " last_error = ?, status = ? WHERE id = ?",
+            (attempts, next_attempt_at, error, "dead" if dead else "pending", message_id),
+        )
+
+    def _next_due(self):
+        row = self._conn.execute(
+            "SELECT MIN(MAX(next_attempt_at, locked_until)) FROM outbox WHERE status = 'pending'"
+        ).fetchone()
+        return row[0]
+
+    async def enqueue(self, url: str, payload: dict) -> int:
+        return await self._run(self._enqueue, url, payload)
+
+    async def claim(self, limit: int, lease: float) -> List[dict]:
+        return await self._run(self._claim, limit, lease)
+
+    async def delivered(self, message_id: int) -> None:
+        await self._run(self._delivered, message_id)
+
+    async def failed(
+        self, message_id: int, attempts: int, next_attempt_at: float, error: str, dead: bool
+    ) -> None:
+        await self._run(self._failed, message_id, attempts, next_attempt_at, error, dead)
+
+    async def next_due(self) -> Optional[float]:
+        """Momento en que vence el próximo mensaje pendiente (None si no hay)."""
+        return await self._run(self._next_due)
+
+    async def close(self) -> None:
+        await self._run(self._conn.close)
+
+
+class OutboxDispatcher:
+    """
+    Entrega en segundo plano los mensajes del outbox.
+
+    A lo más `concurrency` envíos simultáneos. Los fallos se reintentan con
+    backoff exponencial con jitter completo; tras `max_attempts` el mensaje
+    queda como 'dead' en la tabla para revisarlo a mano.
+    """
+
+    def __init__(
+        self,
+        outbox: Outbox,
+        client: httpx.AsyncClient,
+        *,
+        concurrency: int = 8,
+        max_attempts: int = 10,
+        base_delay: float = 1.0,
+        max_delay: float = 300.0,
+        timeout: float = 10.0,
+        poll_interval: float = 5.0,
+        upstream: str = "webhook",
+    ):
+        self.outbox = outbox
+        self.upstream = upstream
+        self.client = client
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self._tasks = set()
+
+    def wake(self) -> None:
+        """Avisa que hay un mensaje nuevo, sin esperar al próximo poll."""
+        self._wakeup.set()
+
+    def _backoff(self, attempts: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempts))
+
+    async def _deliver(self, message: dict) -> None:
+        try:
+            with track_upstream(self.upstream):
+                response = await self.client.post(
+                    message["url"],
+                    json=message["payload"],
+                    headers={"Idempotency-Key": f"outbox-{message['id']}"},
+                    timeout=self.timeout,
+                )
+                response.raise_for_status()
+        except Exception as e:
+            attempts = message["attempts"] + 1
+            dead = attempts >= self.max_attempts
+            await self.outbox.failed(
+                message["id"], attempts, time.time() + self._backoff(attempts), str(e), dead
+            )
+            logger.warning(
+                "Error entregando webhook %s (intento %d): %s", message["id"], attempts, e,
+                extra={"outbox_id": message["id"], "dead": dead},
+            )
+        else:
+            await self.outbox.delivered(message["id"])
+            logger.info("Webhook %s entregado a %s", message["id"], message["url"])
+        finally:
+            # Liberó un cupo (y quizás cambió el próximo vencimiento)
+            self.wake()
+
+    async def _dispatch_once(self) -> int:
+        free = self.concurrency - len(self._tasks)
+        # El arriendo cubre el timeout del envío con margen
+        messages = await self.outbox.claim(free, lease=self.timeout * 3)
+        for message in messages:
+            task = asyncio.create_task(self._deliver(message))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return len(messages)
+
+    async def run(self) -> None:
+        while True:
+            if len(self._tasks) >= self.concurrency:
+                # Sin cupo: esperamos a que termine algún envío
+                await asyncio.wait(self._tasks, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            try:
+                claimed = await self._dispatch_once()
+                if claimed:
+                    continue
+                next_due = await self.outbox.next_due()
+                wait = self.poll_interval
+                if next_due is not None:
+                    wait = min(wait, max(0.0, next_due - time.time()))
+            except Exception:
+                logger.exception("Error en dispatcher del outbox")
+                wait = self.poll_interval
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self) -> None:
+        """Espera los envíos en curso (lo no entregado queda en el outbox)."""
+        if self._tasks:
+            await asyncio.wait(self._tasks, timeout=self.timeout)
@@ -0,0 +1,253 @@
+import asyncio
+import fcntl
+import logging
+import mmap
+import os
+import pickle
+import re
+import struct
+import threading
+import time
+import zlib
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Cada frame: largo + crc32 del payload, y el payload (pickle)
+_HEADER = struct.Struct("<II")
+_SEGMENT = re.compile(r"^(wal|snapshot)-(\d{12})\.(log|bin)$")
+# Filas por frame del snapshot: cada pickle.dumps retiene el GIL, así que
+# frames chicos para no frenar el event loop mientras se escribe
+_SNAPSHOT_CHUNK = 1000
+
+# Cada token se guarda como una fila (tupla) que arma el store: el log no
+# mira su contenido. capture() devuelve, sin ceder el event loop, una función
+# que genera los pares (token, fila) del estado en ese instante; se itera
+# desde un thread.
+Rows = Dict[str, tuple]
+Capture = Callable[[], Callable[[], Iterable[Tuple[str, tuple]]]]
+
+
+def _frame(obj) -> bytes:
+    payload = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    return _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _read_frames(path: str) -> Tuple[List[object], int]:
+    """
+    Frames válidos de un archivo (vía mmap) y el offset donde terminan. Un
+    frame cortado o corrupto al final (caída a medio escribir) corta la lectura.
+    """
+    frames = []
+    offset = 0
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return frames, 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            while offset + _HEADER.size <= size:
+                length, crc = _HEADER.unpack_from(mm, offset)
+                start = offset + _HEADER.size
+                if start + length > size:
+                    break
+                payload = mm[start:start + length]
+                if zlib.crc32(payload) != crc:
+                    break
+                frames.append(pickle.loads(payload))
+                offset = start + length
+    return frames, offset
+
+
+def _fsync_dir(directory: str) -> None:
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class TransactionLog:
+    """
+    Persistencia del store en memoria: write-ahead log + snapshots.
+
+    Cada escritura se agrega a una lista en memoria (sin I/O en el request)
+    y `run` la baja a disco cada `fsync_interval` segundos como un solo
+    frame, con un write + fsync para todo el lote (group commit). Ante una
+    caída se pierde a lo más esa ventana; un apagado normal (`close`) no
+    pierde nada.
+
+    El WAL va en segmentos `wal-<n>.log`. Cada `snapshot_interval` segundos
+    (o si el segmento supera `snapshot_wal_bytes`) se abre un segmento nuevo,
+    se copia el estado del store en ese mismo instante y se escribe en
+    `snapshot-<n>.bin` desde un thread; recién entonces se borran los
+    segmentos y snapshots anteriores. Al arrancar se carga el último
+    snapshot y se aplican los segmentos desde el suyo en adelante.
+
+    Un directorio sólo puede usarlo un proceso a la vez (flock).
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        *,
+        fsync_interval: float = 0.01,
+        snapshot_interval: float = 300.0,
+        snapshot_wal_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_wal_bytes = snapshot_wal_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock_fd = os.open(os.path.join(directory, "LOCK"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self._lock_fd)
+            raise RuntimeError(f"{directory} está en uso por otro proceso")
+        self._pending = []
+        self._io_lock = threading.Lock()
+        self._flushing: Optional[asyncio.Future] = None
+        self._segment = 0
+        self._segment_bytes = 0
+        self._wal_fd: Optional[int] = None
+        self._last_snapshot = time.monotonic()
+
+    def _files(self) -> Dict[str, List[int]]:
+        found = {"wal": [], "snapshot": []}
+        for name in os.listdir(self.directory):
+            match = _SEGMENT.match(name)
+            if match:
+                found[match.group(1)].append(int(match.group(2)))
+        return {kind: sorted(numbers) for kind, numbers in found.items()}
+
+    def _path(self, kind: str, number: int) -> str:
+        extension = "log" if kind == "wal" else "bin"
+        return os.path.join(self.directory, f"{kind}-{number:012d}.{extension}")
+
+    def recover(self) -> Rows:
+        """Estado guardado: último snapshot + WAL posterior. Abre el segmento para escribir."""
+        files = self._files()
+        rows: Rows = {}
+        base = 0
+        start = time.perf_counter()
+        if files["snapshot"]:
+            base = files["snapshot"][-1]
+            chunks, _ = _read_frames(self._path("snapshot", base))
+            for chunk in chunks:
+                rows.update(chunk)
+        replayed = 0
+        segments = [number for number in files["wal"] if number >= base]
+        for number in segments:
+            path = self._path("wal", number)
+            frames, end = _read_frames(path)
+            if end < os.path.getsize(path):
+                logger.warning("WAL %s truncado en el byte %d (escritura incompleta)", path, end)
+                os.truncate(path, end)
+            for batch in frames:
+                for token, row in batch:
+                    if row is None:
+                        rows.pop(token, None)
+                    else:
+                        rows[token] = row
+                replayed += len(batch)
+        logger.info(
+            "Store recuperado: %d registros (snapshot %d + %d operaciones del WAL) en %.2fs",
+            len(rows), base, replayed, time.perf_counter() - start,
+        )
+        # Se sigue escribiendo en un segmento nuevo: los anteriores quedan intactos
+        self._open_segment(max([base, *segments]) + 1)
+        return rows
+
+    def _open_segment(self, number: int) -> None:
+        if self._wal_fd is not None:
+            os.close(self._wal_fd)
+        self._segment = number
+        self._segment_bytes = 0
+        self._wal_fd = os.open(
+            self._path("wal", number), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644
+        )
+        _fsync_dir(self.directory)
+
+    def append(self, token: str, row: tuple) -> None:
+        self._pending.append((token, row))
+
+    def append_delete(self, token: str) -> None:
+        self._pending.append((token, None))
+
+    def _write(self, fd: int, batch: list) -> int:
+        # Un frame por lote: las filas no se mutan, se pueden serializar acá
+        data = _frame(batch)
+        with self._io_lock:
+            view = memoryview(data)
+            while view:
+                written = os.write(fd, view)
+                view = view[written:]
+            os.fdatasync(fd)
+        return len(data)
+
+    async def flush(self) -> None:
+        """Baja lo pendiente a disco: un frame, un write y un fsync por lote."""
+        if self._flushing is not None and not self._flushing.done():
+            await asyncio.shield(self._flushing)
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        self._flushing = asyncio.ensure_future(asyncio.to_thread(self._write, self._wal_fd, batch))
+        self._segment_bytes += await asyncio.shield(self._flushing)
+
+    def _write_snapshot(self, number: int, generate: Callable[[], Iterable[Tuple[str, tuple]]]) -> int:
+        rows = list(generate())
+        path = self._path("snapshot", number)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            for i in range(0, len(rows), _SNAPSHOT_CHUNK):
+                f.write(_frame(rows[i:i + _SNAPSHOT_CHUNK]))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        _fsync_dir(self.directory)
+        # El snapshot nuevo cubre todo lo anterior a su segmento
+        files = self._files()
+        for old in files["wal"]:
+            if old < number:
+                os.remove(self._path("wal", old))
+        for old in files["snapshot"]:
+            if old < number:
+                os.remove(self._path("snapshot", old))
+        return len(rows)
+
+    async def snapshot(self, capture: Capture) -> None:
+        """
+        Rota el WAL y guarda el estado. `capture` se llama justo después de
+        rotar, sin ceder el event loop entremedio: el snapshot queda
+        exactamente en la frontera entre el segmento viejo y el nuevo.
+        """
+        await self.flush()
+        number = self._segment + 1
+        self._open_segment(number)
+        rows = capture()
+        self._last_snapshot = time.monotonic()
+        start = time.perf_counter()
+        count = await asyncio.to_thread(self._write_snapshot, number, rows)
+        logger.info("Snapshot %d: %d registros en %.2fs", number, count, time.perf_counter() - start)
+
+    async def run(self, capture: Capture) -> None:
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            try:
+                await self.flush()
+                due = time.monotonic() - self._last_snapshot >= self.snapshot_interval
+                if self._segment_bytes and (due or self._segment_bytes >= self.snapshot_wal_bytes):
+                    await self.snapshot(capture)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Error escribiendo el WAL del store")
+
+    async def close(self) -> None:
+        await self.flush()
+        if self._wal_fd is not None:
+            os.close(self._wal_fd)
+            self._wal_fd = None
+        os.close(self._lock_fd)
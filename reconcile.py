@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+from typing import Awaitable, Callable, Optional
+
+import metrics
+from store import TransactionStore
+from transbank import TransbankClient, TransbankError, TransbankUnavailable
+
+logger = logging.getLogger(__name__)
+
+# on_result(token, record, result): result es la respuesta de Transbank, o
+# None si Transbank ya no conoce el token
+ResultHandler = Callable[[str, dict, Optional[dict]], Awaitable[None]]
+
+# Estados de Transbank que ya no cambian solos. INITIALIZED (el cliente
+# todavía en el formulario de Webpay) y cualquier otro no están.
+FINAL_STATUSES = {"AUTHORIZED", "FAILED", "REVERSED", "NULLIFIED", "PARTIALLY_NULLIFIED", "CAPTURED"}
+
+
+class ReconciliationSweeper:
+    """
+    Barrido periódico de transacciones Webpay que quedaron pendientes porque
+    el usuario no volvió a la página de resultado (cerró el navegador, se
+    cortó la conexión...).
+
+    Cada `interval` segundos toma los pendientes creados hace más de
+    `older_than` segundos, consulta su estado en Transbank (a lo más
+    `concurrency` a la vez, por páginas de `page_size`) y entrega el
+    resultado a `on_result`, que lo aplica igual que confirm_payment.
+
+    Un pago AUTHORIZED que nadie confirmó todavía se confirma acá (commit,
+    con el mismo lock que confirm_payment): sin commit Transbank no lo
+    captura. Se entrega el resultado del commit.
+
+    Sólo se entrega (y el pendiente vence) un estado final o un 4xx de
+    Transbank. Un token que sigue INITIALIZED se deja pendiente hasta
+    `created_at + pending_window` (por defecto la vida del pendiente en el
+    store): el cliente puede estar todavía pagando.
+
+    `older_than` tiene que ser menor que la vida de un pendiente en el store
+    (WEBPAY_TOKEN_TTL): si no, el registro se purga antes de revisarlo.
+
+    Con varios workers sólo uno barre por intervalo (lock en el store), y
+    cada token se revisa con el mismo lock que usa confirm_payment.
+    """
+
+    def __init__(
+        self,
+        store: TransactionStore,
+        transbank: TransbankClient,
+        on_result: ResultHandler,
+        *,
+        older_than: float = 360.0,
+        interval: float = 60.0,
+        concurrency: int = 10,
+        page_size: int = 500,
+        lock_ttl: float = 30.0,
+        pending_window: Optional[float] = None,
+    ):
+        if older_than >= store.policy.pending_ttl:
+            raise ValueError(
+                f"RECONCILE_AFTER ({older_than:.0f}s) debe ser menor que "
+                f"WEBPAY_TOKEN_TTL ({store.policy.pending_ttl:.0f}s)"
+            )
+        self.store = store
+        self.transbank = transbank
+        self.on_result = on_result
+        self.older_than = older_than
+        self.interval = interval
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.lock_ttl = lock_ttl
+        self.pending_window = store.policy.pending_ttl if pending_window is None else pending_window
+
+    async def reconcile(self, token: str) -> str:
+        """
+        Revisa un pendiente contra Transbank y entrega el resultado; también
+        lo usa el vencimiento de holds (ver slots.py).
+        """
+        lock_name = f"confirm:{token}"
+        owner = await self.store.acquire_lock(lock_name, self.lock_ttl)
+        if owner is None:
+            # confirm_payment lo está procesando justo ahora
+            return "skipped"
+        try:
+            record = await self.store.get(token)
+            if record is None or record.get("status") != "pending":
+                return "skipped"
+            try:
+                result = await self.transbank.get_transaction_status(token)
+            except TransbankUnavailable:
+                return "unavailable"
+            except TransbankError as e:
+                if e.status_code >= 500:
+                    return "error"
+                # 4xx: token inválido o vencido para Transbank
+                result = None
+            if (
+                result is not None
+                and result.get("status") not in FINAL_STATUSES
+                and time.time() < record.get("created_at", 0.0) + self.pending_window
+            ):
+                return "pending"
+            if result is not None and result.get("status") == "AUTHORIZED":
+                try:
+                    result = await self.transbank.commit_transaction(token)
+                except TransbankUnavailable:
+                    return "unavailable"
+                except TransbankError as e:
+                    if e.status_code >= 500:
+                        return "error"
+                    # 4xx: ya confirmada por otro camino; vale el estado consultado
+            await self.on_result(token, record, result)
+            return "authorized" if result and result.get("status") == "AUTHORIZED" else "expired"
+        except Exception:
+            logger.exception("Error conciliando token", extra={"token": token})
+            return "error"
+        finally:
+            await self.store.release_lock(lock_name, owner)
+
+    async def sweep(self) -> Counter:
+        """Un barrido completo; devuelve la cantidad de tokens por resultado."""
+        counts = Counter()
+        cupos = asyncio.Semaphore(self.concurrency)
+
+        async def reconcile(token: str) -> str:
+            async with cupos:
+                return await self.reconcile(token)
+
+        start = time.perf_counter()
+        cutoff = time.time() - self.older_than
+        after = 0.0
+        while True:
+            page = await self.store.list_pending(cutoff, self.page_size, after)
+            if not page:
+                break
+            results = await asyncio.gather(*(reconcile(token) for token, _ in page))
+            counts.update(results)
+            if "unavailable" in results:
+                # Transbank caído o circuito abierto: el resto queda para la próxima
+                break
+            last = page[-1][1].get("created_at", 0.0)
+            if len(page) < self.page_size or last <= after:
+                break
+            after = last
+        metrics.RECONCILE_SWEEP_DURATION.observe(time.perf_counter() - start)
+        for result, count in counts.items():
+            metrics.RECONCILE_TRANSACTIONS.labels(result).inc(count)
+        return counts
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                # Se deja vencer solo: los demás workers no barren este intervalo
+                if await self.store.acquire_lock("reconcile", self.interval) is None:
+                    continue
+                counts = await self.sweep()
+                if counts:
+                    logger.info("Conciliación de pendientes: %s", dict(counts), extra=dict(counts))
+            except Exception:
+                logger.exception("Error en el barrido de pendientes")
@@ -0,0 +1,120 @@
+import json
+import sys
+import zlib
+from typing import Iterable, Optional
+
+# Campos de ReservationPaymentRequest, en orden: reserva_data se guarda como
+# tupla cuando trae exactamente estas claves. Los campos nuevos van al final:
+# una tupla más corta (WAL / snapshots anteriores a service_id) son los
+# primeros campos, y se sigue leyendo con zip.
+RESERVA_FIELDS = ("name", "email", "start_time", "end_time", "amount", "service_name", "phone", "service_id")
+# Largo de la tupla -> claves, para cada versión del formato
+_RESERVA_LAYOUTS = {length: frozenset(RESERVA_FIELDS[:length]) for length in (7, len(RESERVA_FIELDS))}
+
+
+class _Missing:
+    """Campo ausente. Se serializa por nombre para seguir siendo único al cargarlo (ver persistence.py)."""
+
+    __slots__ = ()
+
+    def __reduce__(self):
+        return "_MISSING"
+
+    def __repr__(self):
+        return "<missing>"
+
+
+_MISSING = _Missing()
+
+
+def _to_ms(value):
+    return int(round(value * 1000)) if isinstance(value, (int, float)) else value
+
+
+def _from_ms(value):
+    return value / 1000 if isinstance(value, int) else value
+
+
+class CompactRecord:
+    """
+    Representación compacta de un registro del store en memoria.
+
+    En vez de un dict por registro más uno por reserva y otro por el detalle
+    de Transbank:
+
+    - los campos conocidos van en slots; los demás, en `extra`;
+    - el estado se interna (todos los "AUTHORIZED" son el mismo objeto);
+    - created_at / updated_at se guardan como enteros en milisegundos
+      (`to_dict` los devuelve en segundos, redondeados al milisegundo);
+    - reserva_data va como tupla en el orden de RESERVA_FIELDS (o de sus
+      primeros 7, el formato previo a service_id);
+    - details va como JSON comprimido con zlib, opcionalmente recortado a
+      `details_fields`.
+
+    `to_dict` reconstruye el dict original.
+    """
+
+    __slots__ = (
+        "status", "buy_order", "amount", "created_ms", "updated_ms", "reserva", "details", "extra",
+    )
+
+    @classmethod
+    def from_dict(
+        cls, record: dict, details_fields: Optional[Iterable[str]] = None
+    ) -> "CompactRecord":
+        self = cls()
+        record = dict(record)
+        status = record.pop("status", _MISSING)
+        self.status = sys.intern(status) if isinstance(status, str) else status
+        self.buy_order = record.pop("buy_order", _MISSING)
+        self.amount = record.pop("amount", _MISSING)
+        self.created_ms = _to_ms(record.pop("created_at", _MISSING))
+        self.updated_ms = _to_ms(record.pop("updated_at", _MISSING))
+
+        reserva = record.pop("reserva_data", _MISSING)
+        if isinstance(reserva, dict) and reserva.keys() == _RESERVA_LAYOUTS.get(len(reserva)):
+            reserva = tuple(
+                sys.intern(reserva[key]) if key == "service_name" and isinstance(reserva[key], str)
+                else reserva[key]
+                for key in RESERVA_FIELDS[:len(reserva)]
+            )
+        self.reserva = reserva
+
+        details = record.pop("details", _MISSING)
+        if isinstance(details, dict) and details:
+            if details_fields is not None:
+                details = {key: details[key] for key in details_fields if key in details}
+            details = zlib.compress(json.dumps(details, separators=(",", ":")).encode())
+        self.details = details
+
+        self.extra = record or None
+        return self
+
+    @property
+    def created_at(self) -> float:
+        created = _from_ms(self.created_ms)
+        return 0.0 if created is _MISSING else created
+
+    def to_dict(self) -> dict:
+        record = {}
+        if self.status is not _MISSING:
+            record["status"] = self.status
+        if self.buy_order is not _MISSING:
+            record["buy_order"] = self.buy_order
+        if self.amount is not _MISSING:
+            record["amount"] = self.amount
+        if self.created_ms is not _MISSING:
+            record["created_at"] = _from_ms(self.created_ms)
+        if self.updated_ms is not _MISSING:
+            record["updated_at"] = _from_ms(self.updated_ms)
+        if isinstance(self.reserva, tuple):
+            record["reserva_data"] = dict(zip(RESERVA_FIELDS, self.reserva))
+        elif self.reserva is not _MISSING:
+            record["reserva_data"] = self.reserva
+        if isinstance(self.details, bytes):
+            record["details"] = json.loads(zlib.decompress(self.details))
+        elif self.details is not _MISSING:
+            record["details"] = self.details
+        if self.extra:
+            record.update(self.extra)
+        return record
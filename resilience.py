@@ -0,0 +1,114 @@
+import time
+from collections import deque
+
+import metrics
+
+
+class CircuitOpenError(Exception):
+    """El circuito está abierto: no se intenta la llamada."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Circuito {name} abierto, reintentar en {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class AdaptiveTimeout:
+    """
+    Timeout derivado de la latencia observada: `factor` veces el percentil
+    `percentile` de las últimas `window` llamadas exitosas, acotado entre
+    `minimum` y `maximum`. Hasta juntar `min_samples` se usa `maximum`.
+    """
+
+    def __init__(
+        self,
+        *,
+        minimum: float = 2.0,
+        maximum: float = 30.0,
+        factor: float = 3.0,
+        percentile: float = 0.99,
+        window: int = 200,
+        min_samples: int = 20,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._current = maximum
+        self._dirty = False
+
+    def observe(self, latency: float) -> None:
+        self._samples.append(latency)
+        self._dirty = True
+
+    @property
+    def current(self) -> float:
+        if self._dirty:
+            self._dirty = False
+            if len(self._samples) >= self.min_samples:
+                ordered = sorted(self._samples)
+                index = min(len(ordered) - 1, int(len(ordered) * self.percentile))
+                self._current = min(self.maximum, max(self.minimum, ordered[index] * self.factor))
+        return self._current
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker clásico:
+
+    - closed: las llamadas pasan; `failure_threshold` fallos seguidos lo abren.
+    - open: se falla de inmediato con CircuitOpenError durante `reset_timeout`.
+    - half_open: pasado ese plazo se deja pasar una llamada de prueba; si
+      funciona se cierra, si falla vuelve a abrirse.
+
+    El estado se publica en `circuit_breaker_state{name}` (0/1/2).
+    """
+
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+    _STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name: str, *, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._set_state(self.CLOSED)
+
+    def _set_state(self, state: str) -> None:
+        self.state = state
+        metrics.CIRCUIT_BREAKER_STATE.labels(self.name).set(self._STATE_VALUES[state])
+
+    def before_call(self) -> None:
+        """Llamar antes de cada intento; lanza CircuitOpenError si no corresponde."""
+        if self.state == self.OPEN:
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                raise CircuitOpenError(self.name, remaining)
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            if self._trial_in_flight:
+                raise CircuitOpenError(self.name, self.reset_timeout)
+            self._trial_in_flight = True
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._trial_in_flight = False
+        if self.state != self.CLOSED:
+            self._set_state(self.CLOSED)
+
+    def release(self) -> None:
+        """La llamada terminó sin veredicto (p. ej. se canceló)."""
+        self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        self._trial_in_flight = False
+        if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            self._set_state(self.OPEN)
@@ -0,0 +1,32 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    Coalesce llamadas concurrentes con la misma clave dentro del proceso.
+
+    La primera llamada ejecuta `fn`; las que llegan mientras está en curso
+    esperan y reciben el mismo resultado (o la misma excepción). `fn` corre
+    en su propia task, así que si se cancela quien la inició los demás
+    siguen esperando normalmente.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._inflight
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
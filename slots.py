@@ -0,0 +1,407 @@
+import asyncio
+import itertools
+import logging
+import math
+import random
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import metrics
+from timers import TimerWheel
+
+logger = logging.getLogger(__name__)
+
+# Estados que ocupan el horario: pendiente (link enviado, hold) y pagada
+HELD_STATUS = "pending"
+CONFIRMED_STATUS = "AUTHORIZED"
+
+
+class SlotConflict(Exception):
+    """El horario pedido se cruza con una reserva retenida o pagada."""
+
+
+def parse_time(value) -> Optional[float]:
+    """ISO 8601 (con o sin zona, "Z" incluida) a epoch; None si no se entiende."""
+    if not isinstance(value, str):
+        return None
+    try:
+        return datetime.fromisoformat(value.strip().replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+
+def service_key(service_name: str) -> str:
+    return service_name.strip().lower()
+
+
+def reservation_slot(record: dict) -> Optional[Tuple[str, float, float]]:
+    """(servicio normalizado, start, end) de la reserva_data del registro; None si no tiene."""
+    reserva = record.get("reserva_data")
+    if not isinstance(reserva, dict):
+        return None
+    start = parse_time(reserva.get("start_time"))
+    end = parse_time(reserva.get("end_time"))
+    service = reserva.get("service_name")
+    if start is None or end is None or not isinstance(service, str) or not service.strip():
+        return None
+    return service_key(service), start, end
+
+
+DAY = 86400.0
+# Días (por servicio) de ocupación precalculada que se guardan a la vez
+BUSY_CACHE_SIZE = 4096
+
+
+def _days(start: float, end: float) -> range:
+    """Días (epoch // DAY) que toca [start, end); al menos el de `start`."""
+    first = int(start // DAY)
+    return range(first, max(first + 1, math.ceil(end / DAY)))
+
+
+def free_slots(busy: List[Tuple[float, float]], start: float, end: float, length: float) -> List[float]:
+    """
+    Inicios de los bloques de `length` segundos, alineados desde `start`, que
+    caben en [start, end) sin tocar `busy` (intervalos ordenados y fusionados).
+    Un solo recorrido sobre ambos.
+    """
+    found = []
+    i = 0
+    t = start
+    while t + length <= end:
+        while i < len(busy) and busy[i][1] <= t:
+            i += 1
+        if i == len(busy) or busy[i][0] >= t + length:
+            found.append(t)
+        t += length
+    return found
+
+
+class _Node:
+    __slots__ = ("key", "end", "priority", "max_end", "left", "right")
+
+    def __init__(self, key: Tuple[float, float, str]):
+        self.key = key
+        self.end = key[1]
+        self.priority = random.random()
+        self.max_end = self.end
+        self.left = None
+        self.right = None
+
+    def update(self) -> None:
+        max_end = self.end
+        if self.left is not None and self.left.max_end > max_end:
+            max_end = self.left.max_end
+        if self.right is not None and self.right.max_end > max_end:
+            max_end = self.right.max_end
+        self.max_end = max_end
+
+
+def _split(node, key):
+    """(claves < key, claves >= key)."""
+    if node is None:
+        return None, None
+    if node.key < key:
+        node.right, right = _split(node.right, key)
+        node.update()
+        return node, right
+    left, node.left = _split(node.left, key)
+    node.update()
+    return left, node
+
+
+def _merge(left, right):
+    """Todas las claves de `left` son menores que las de `right`."""
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        left.update()
+        return left
+    right.left = _merge(left, right.left)
+    right.update()
+    return right
+
+
+class IntervalTreap:
+    """
+    Intervalos semiabiertos [start, end) en un treap ordenado por
+    (start, end, id) y aumentado con el máximo `end` de cada subárbol.
+
+    Insertar y borrar cuestan O(log n) esperado. `overlapping` descarta los
+    subárboles cuyo máximo `end` no alcanza al intervalo pedido y deja de
+    bajar a la derecha apenas los inicios lo superan: O(log n + k).
+    """
+
+    def __init__(self):
+        self._root = None
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def insert(self, start: float, end: float, id: str) -> None:
+        key = (start, end, id)
+        left, right = _split(self._root, key)
+        self._root = _merge(_merge(left, _Node(key)), right)
+        self._size += 1
+
+    def remove(self, start: float, end: float, id: str) -> bool:
+        key = (start, end, id)
+        left, right = _split(self._root, key)
+        # right empieza en `key` si existe: se separa ese único nodo
+        middle, right = _split(right, (start, end, id + "\0"))
+        self._root = _merge(left, right)
+        if middle is None:
+            return False
+        self._size -= 1
+        return True
+
+    def overlapping(self, start: float, end: float) -> List[Tuple[float, float, str]]:
+        found = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node is None or node.max_end <= start:
+                continue
+            stack.append(node.left)
+            node_start, node_end, _ = node.key
+            if node_start < end:
+                if node_end > start:
+                    found.append(node.key)
+                stack.append(node.right)
+        found.sort()
+        return found
+
+
+class SlotIndex:
+    """
+    Horarios ocupados por servicio, para rechazar con 409 una reserva que se
+    cruza con otra antes de crear la transacción en Transbank.
+
+    Se alimenta de los cambios del store (`observe`, registrado como
+    listener): un pendiente con reserva_data retiene el horario (hold) por
+    `hold_ttl` desde su creación, uno AUTHORIZED lo ocupa hasta su `end` y
+    cualquier otro estado lo libera.
+
+    Los vencimientos de los holds y el término de las pagadas van en una
+    TimerWheel que `run` avanza cada `resolution` segundos; una pagada que
+    terminó simplemente sale del índice. Por cada hold vencido se llama
+    `on_expire(token)`, que resuelve el pendiente (y con eso lo saca del
+    índice vía `observe`); si devuelve False no se pudo resolver todavía y
+    el hold sigue retenido `retry_interval` segundos más. Un hold vencido
+    que todavía no se procesa ya no cuenta como conflicto.
+
+    `busy` entrega la ocupación fusionada de un rango (para la consulta de
+    disponibilidad); se calcula por (servicio, día) y se guarda hasta que
+    cambia una reserva de ese día o vence uno de sus holds.
+
+    Entre la verificación y el `set` del token hay una llamada a Transbank:
+    `claim` reserva el horario en el índice mientras tanto, así dos requests
+    simultáneos por la misma hora no pasan ambos.
+
+    El índice es del proceso. Con Redis los cambios de los demás workers
+    llegan por pub/sub; con SQLite y varios workers cada uno ve sólo los
+    suyos, así que la reserva además se verifica contra el store
+    (`store.claim_slot`). Al arrancar se reconstruye con `rebuild` desde lo
+    que el store retiene: las pagadas se guardan al menos hasta su `end`.
+    """
+
+    def __init__(
+        self,
+        hold_ttl: float,
+        on_expire: Optional[Callable[[str], Awaitable[bool]]] = None,
+        *,
+        resolution: float = 1.0,
+        retry_interval: float = 30.0,
+        concurrency: int = 10,
+    ):
+        self.hold_ttl = hold_ttl
+        self.on_expire = on_expire
+        self.retry_interval = retry_interval
+        self.concurrency = concurrency
+        self._trees: Dict[str, IntervalTreap] = {}
+        # id -> (servicio, start, end, vence o None si está pagada)
+        self._entries: Dict[str, Tuple[str, float, float, Optional[float]]] = {}
+        self._claims = itertools.count()
+        self._wheel = TimerWheel(resolution, now=time.time())
+        # (servicio, día) -> (ocupados fusionados, válido hasta el primer hold que vence)
+        self._busy_days: Dict[Tuple[str, int], Tuple[List[Tuple[float, float]], float]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, id: str, service: str, start: float, end: float, expires_at: Optional[float]) -> None:
+        current = self._entries.get(id)
+        if current is None or current[:3] != (service, start, end):
+            self.remove(id)
+            self._trees.setdefault(service, IntervalTreap()).insert(start, end, id)
+        self._entries[id] = (service, start, end, expires_at)
+        self._invalidate(service, start, end)
+        # Las pagadas se programan a su término, para sacarlas del índice
+        self._wheel.schedule(id, end if expires_at is None else expires_at)
+
+    def remove(self, id: str) -> None:
+        current = self._entries.pop(id, None)
+        if current is None:
+            return
+        self._wheel.cancel(id)
+        service, start, end, _ = current
+        tree = self._trees[service]
+        tree.remove(start, end, id)
+        if not len(tree):
+            del self._trees[service]
+        self._invalidate(service, start, end)
+
+    def _invalidate(self, service: str, start: float, end: float) -> None:
+        for day in _days(start, end):
+            self._busy_days.pop((service, day), None)
+
+    def _busy_day(self, service: str, day: int, now: float) -> List[Tuple[float, float]]:
+        key = (service, day)
+        cached = self._busy_days.get(key)
+        if cached is not None and now < cached[1]:
+            metrics.CACHE_REQUESTS.labels("availability", "hit").inc()
+            return cached[0]
+        metrics.CACHE_REQUESTS.labels("availability", "miss").inc()
+        low, high = day * DAY, (day + 1) * DAY
+        tree = self._trees.get(service)
+        merged = []
+        valid_until = math.inf
+        # overlapping viene ordenado por inicio: basta fusionar con el último
+        for start, end, id in tree.overlapping(low, high) if tree is not None else ():
+            expires_at = self._entries[id][3]
+            if expires_at is not None:
+                if expires_at <= now:
+                    continue
+                valid_until = min(valid_until, expires_at)
+            start, end = max(start, low), min(end, high)
+            if merged and start <= merged[-1][1]:
+                if end > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], end)
+            else:
+                merged.append((start, end))
+        if len(self._busy_days) >= BUSY_CACHE_SIZE:
+            # El más antiguo en entrar (los dicts mantienen el orden de inserción)
+            del self._busy_days[next(iter(self._busy_days))]
+        self._busy_days[key] = (merged, valid_until)
+        return merged
+
+    def busy(self, service: str, start: float, end: float) -> List[Tuple[float, float]]:
+        """Tramos ocupados de [start, end) en `service`, ordenados y fusionados."""
+        service = service_key(service)
+        now = time.time()
+        merged = []
+        for day in _days(start, end):
+            for low, high in self._busy_day(service, day, now):
+                low, high = max(low, start), min(high, end)
+                if low >= high:
+                    continue
+                # Una reserva que cruza la medianoche queda partida en dos días
+                if merged and low <= merged[-1][1]:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+                else:
+                    merged.append((low, high))
+        return merged
+
+    def conflicts(self, service: str, start: float, end: float) -> List[str]:
+        """Ids que ocupan algo de [start, end) en `service` (sin los holds vencidos)."""
+        tree = self._trees.get(service_key(service))
+        if tree is None:
+            return []
+        now = time.time()
+        found = []
+        for _, _, id in tree.overlapping(start, end):
+            expires_at = self._entries[id][3]
+            if expires_at is None or expires_at > now:
+                found.append(id)
+        return found
+
+    def claim(self, service: str, start: float, end: float, ttl: float) -> str:
+        """
+        Retiene [start, end) por `ttl` segundos si está libre y devuelve el id
+        del claim (se libera con `remove`); si no, levanta SlotConflict.
+        """
+        if self.conflicts(service, start, end):
+            raise SlotConflict(service)
+        id = f"claim:{next(self._claims)}"
+        self.add(id, service_key(service), start, end, time.time() + ttl)
+        return id
+
+    def observe(self, token: str, record: dict) -> None:
+        if not isinstance(record.get("reserva_data"), dict):
+            return
+        status = record.get("status")
+        slot = reservation_slot(record)
+        if status not in (HELD_STATUS, CONFIRMED_STATUS) or slot is None:
+            self.remove(token)
+            return
+        service, start, end = slot
+        expires_at = None
+        if status == HELD_STATUS:
+            expires_at = record.get("created_at", time.time()) + self.hold_ttl
+        elif end <= time.time():
+            # Pagada que ya terminó: no ocupa nada
+            self.remove(token)
+            return
+        self.add(token, service, start, end, expires_at)
+
+    async def _expire(self, token: str) -> None:
+        try:
+            resolved = self.on_expire is None or await self.on_expire(token)
+        except Exception:
+            logger.exception("Error venciendo hold", extra={"token": token})
+            resolved = False
+        current = self._entries.get(token)
+        if current is None or current[3] is None:
+            # Ya salió del índice o se resolvió como pagada (observe la reprogramó)
+            return
+        if resolved:
+            self.remove(token)
+        else:
+            self.add(token, *current[:3], time.time() + self.retry_interval)
+
+    async def run(self) -> None:
+        cupos = asyncio.Semaphore(self.concurrency)
+
+        async def expire(token: str) -> None:
+            async with cupos:
+                await self._expire(token)
+
+        while True:
+            await asyncio.sleep(self._wheel.resolution)
+            tokens = []
+            for id in self._wheel.advance(time.time()):
+                current = self._entries.get(id)
+                if current is None:
+                    continue
+                if id.startswith("claim:") or current[3] is None:
+                    # Claim sin usar o reserva pagada que ya terminó
+                    self.remove(id)
+                else:
+                    tokens.append(id)
+            if tokens:
+                metrics.RESERVATION_HOLDS_EXPIRED.inc(len(tokens))
+                await asyncio.gather(*(expire(token) for token in tokens))
+
+    async def rebuild(self, store, page_size: int = 1000) -> int:
+        """Carga los pendientes y pagados del store, página por página."""
+        start = time.perf_counter()
+        loaded = 0
+        for status in (HELD_STATUS, CONFIRMED_STATUS):
+            before = None
+            while True:
+                page = await store.query("status", status, before=before, limit=page_size)
+                for token, record in page:
+                    self.observe(token, record)
+                loaded += len(page)
+                if len(page) < page_size:
+                    break
+                before = (page[-1][1].get("created_at", 0.0), page[-1][0])
+        logger.info(
+            "Índice de horarios: %d reservas en %.2fs", len(self), time.perf_counter() - start,
+            extra={"loaded": loaded},
+        )
+        return len(self)
@@ -0,0 +1,1215 @@
+import asyncio
+import bisect
+import gc
+import heapq
+import itertools
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Iterable, List, Optional, Tuple, TypeVar
+
+import metrics
+from persistence import TransactionLog
+from records import CompactRecord
+from slots import CONFIRMED_STATUS, HELD_STATUS, reservation_slot
+
+logger = logging.getLogger(__name__)
+
+
+# Registros que comparten el store con las transacciones de Webpay sin serlo
+# llevan "kind": no tienen estado de Webpay, así que no entran en los índices
+# (ni en list_pending ni en las consultas por estado) y vencen según su tipo.
+LEDGER_KIND = "mp_ledger"
+IDEMPOTENCY_KIND = "idempotency"
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class ExpiryPolicy:
+    """
+    Tiempo de vida de un registro según su estado.
+
+    Los pendientes viven lo que dura el token de Webpay (si el usuario no
+    volvió, el token ya no sirve); los finalizados se retienen un tiempo para
+    responder re-renders de la página de resultado y luego se descartan. Una
+    reserva pagada se retiene además hasta que termina: es la que ocupa el
+    horario al reconstruir el índice de horarios.
+
+    El ledger de MercadoPago tiene su propia retención (`ledger_ttl`): sus
+    estados son los de MercadoPago, no los de Webpay. Las respuestas
+    idempotentes viven lo que un pendiente (después el link ya no sirve).
+    """
+
+    pending_ttl: float = 600.0
+    finished_ttl: float = 86400.0
+    ledger_ttl: float = 7 * 86400.0
+
+    def ttl_for(self, record: dict) -> float:
+        kind = record.get("kind")
+        if kind == LEDGER_KIND:
+            return self.ledger_ttl
+        if kind == IDEMPOTENCY_KIND:
+            return self.pending_ttl
+        status = record.get("status", "pending")
+        if status == "pending":
+            return self.pending_ttl
+        if status == CONFIRMED_STATUS:
+            slot = reservation_slot(record)
+            if slot is not None:
+                return max(self.finished_ttl, slot[2] - time.time())
+        return self.finished_ttl
+
+    @classmethod
+    def from_env(cls) -> "ExpiryPolicy":
+        return cls(
+            pending_ttl=float(os.getenv("WEBPAY_TOKEN_TTL", cls.pending_ttl)),
+            finished_ttl=float(os.getenv("TRANSACTION_RETENTION", cls.finished_ttl)),
+            ledger_ttl=float(os.getenv("MP_LEDGER_RETENTION", cls.ledger_ttl)),
+        )
+
+
+_SCALARS = (str, int, float, bool, bytes, type(None))
+
+
+def approx_size(obj) -> int:
+    """Estimación barata (sys.getsizeof recursivo) de la memoria que ocupa un registro."""
+    size = sys.getsizeof(obj)
+    if type(obj) in _SCALARS:
+        return size
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += sys.getsizeof(key) + approx_size(value)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            size += approx_size(value)
+    elif hasattr(obj, "__slots__"):
+        for name in obj.__slots__:
+            size += approx_size(getattr(obj, name, None))
+    return size
+
+
+# Índices secundarios (además del orden por created_at). Email y teléfono se
+# normalizan igual al guardar y al consultar.
+INDEXED_FIELDS = ("buy_order", "email", "phone", "status")
+
+
+def normalize_email(email: Optional[str]) -> Optional[str]:
+    if not email:
+        return None
+    return email.strip().lower() or None
+
+
+def normalize_phone(phone: Optional[str]) -> Optional[str]:
+    """Sólo dígitos y con código de país: "+56 9 1234 5678" y "912345678" dan "56912345678"."""
+    if not phone:
+        return None
+    digits = re.sub(r"\D", "", phone)
+    if len(digits) == 9 and digits.startswith("9"):
+        digits = "56" + digits
+    return digits or None
+
+
+def normalize_index_value(field: str, value: str) -> Optional[str]:
+    if field == "email":
+        return normalize_email(value)
+    if field == "phone":
+        return normalize_phone(value)
+    return value
+
+
+def index_values(record: dict) -> Tuple[Optional[str], ...]:
+    """Valores de INDEXED_FIELDS de un registro, en ese orden (None si no aplica)."""
+    if "kind" in record:
+        return (None,) * len(INDEXED_FIELDS)
+    reserva = record.get("reserva_data") or {}
+    return (
+        record.get("buy_order"),
+        normalize_email(reserva.get("email")),
+        normalize_phone(reserva.get("phone")),
+        record.get("status"),
+    )
+
+
+def slot_values(record: dict) -> Tuple[Optional[object], ...]:
+    """(servicio, start, end) de la reserva del registro, o Nones si no tiene."""
+    return reservation_slot(record) or (None, None, None)
+
+
+def _insort_unique(entries: list, entry: tuple) -> None:
+    i = bisect.bisect_left(entries, entry)
+    if i == len(entries) or entries[i] != entry:
+        entries.insert(i, entry)
+
+
+class TransactionStore(ABC):
+    """
+    Almacén de transacciones indexado por token de Transbank.
+
+    Los registros son dicts serializables a JSON. Los backends compartidos
+    (SQLite, Redis) permiten correr varios workers de uvicorn: un token creado
+    en un worker es visible para `confirm_payment` en cualquier otro.
+
+    Cada registro expira según `ExpiryPolicy`; el plazo se recalcula cada vez
+    que se escribe, así un pendiente que pasa a AUTHORIZED toma la retención
+    de los finalizados.
+
+    Además del token, cada backend mantiene índices por INDEXED_FIELDS y por
+    created_at, actualizados en la misma escritura que el registro (ver
+    `query`).
+    """
+
+    # True si los cambios de todos los workers llegan a los listeners (un solo
+    # proceso, o pub/sub del backend); si no, quien espera un cambio tiene que
+    # consultar el store cada tanto.
+    broadcasts_changes = True
+
+    def __init__(self, policy: Optional[ExpiryPolicy] = None):
+        self.policy = policy or ExpiryPolicy()
+        self._listeners = []
+
+    def add_listener(self, listener: Callable[[str, dict], None]) -> None:
+        """
+        Registra `listener(token, record)`, llamado en el event loop después de
+        cada `set`/`update`. Tiene que ser rápido y no bloquear.
+        """
+        self._listeners.append(listener)
+
+    def _emit(self, token: str, record: dict) -> None:
+        for listener in self._listeners:
+            listener(token, record)
+
+    async def listen(self) -> None:
+        """Recibe los cambios hechos por otros workers hasta que se cancela."""
+
+    async def run(self) -> None:
+        """Tareas de fondo propias del backend, hasta que se cancela."""
+
+    @abstractmethod
+    async def get(self, token: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def set(self, token: str, record: dict) -> None:
+        ...
+
+    @abstractmethod
+    async def update(self, token: str, fields: dict) -> Optional[dict]:
+        """Mezcla `fields` en el registro y lo devuelve; None si no existe."""
+
+    @abstractmethod
+    async def delete(self, token: str) -> None:
+        ...
+
+    async def purge_expired(self) -> int:
+        """Elimina los registros vencidos y devuelve cuántos borró."""
+        return 0
+
+    @abstractmethod
+    async def list_pending(
+        self, older_than: float, limit: int, after: float = 0.0
+    ) -> List[Tuple[str, dict]]:
+        """
+        Hasta `limit` registros en estado "pending" con `after < created_at
+        <= older_than`, los más antiguos primero. Para paginar, el siguiente
+        llamado usa como `after` el `created_at` del último.
+        """
+
+    async def query(
+        self,
+        field: Optional[str] = None,
+        value: Optional[str] = None,
+        *,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        before: Optional[Tuple[float, str]] = None,
+        limit: int = 50,
+    ) -> List[Tuple[str, dict]]:
+        """
+        Registros con `field == value` (uno de INDEXED_FIELDS; None = todas
+        las transacciones, sin los registros con "kind") y `start <=
+        created_at < end`, del más nuevo al más antiguo. Para paginar,
+        `before` es el (created_at, token) del último de la página anterior.
+        """
+        if field is not None:
+            if field not in INDEXED_FIELDS:
+                raise ValueError(f"Campo sin índice: {field}")
+            value = normalize_index_value(field, value)
+            if value is None:
+                return []
+        return await self._query(field, value, start, end, before, limit)
+
+    @abstractmethod
+    async def _query(self, field, value, start, end, before, limit) -> List[Tuple[str, dict]]:
+        ...
+
+    @abstractmethod
+    async def acquire_lock(self, name: str, ttl: float) -> Optional[str]:
+        """
+        Lock con vencimiento, visible para todos los workers que comparten el
+        store. Devuelve un identificador de dueño, o None si otro lo tiene.
+        """
+
+    @abstractmethod
+    async def release_lock(self, name: str, owner: str) -> None:
+        """Libera el lock sólo si sigue siendo de `owner`."""
+
+    async def acquire_lock_or_wait(
+        self, name: str, ttl: float, done: Callable[[], Awaitable[Optional[T]]]
+    ) -> Tuple[Optional[str], Optional[T]]:
+        """
+        Toma el lock `name` o espera a quien lo tiene: mientras esté tomado
+        consulta `done()` (con backoff de 50 ms a 500 ms) y vuelve apenas
+        entregue algo. Devuelve (dueño, None) con el lock, (None, resultado)
+        si el otro terminó, o (None, None) si pasaron `ttl` segundos sin
+        ninguna de las dos (quien llama sigue sin lock).
+        """
+        owner = await self.acquire_lock(name, ttl)
+        espera = 0.05
+        deadline = time.monotonic() + ttl
+        while owner is None and time.monotonic() < deadline:
+            await asyncio.sleep(espera)
+            espera = min(espera * 2, 0.5)
+            result = await done()
+            if result is not None:
+                return None, result
+            owner = await self.acquire_lock(name, ttl)
+        return owner, None
+
+    async def stats(self) -> Optional[Tuple[int, int]]:
+        """(cantidad, bytes aproximados), o None si el backend no lo sabe barato."""
+        return None
+
+    async def claim_slot(
+        self, service: str, start: float, end: float, ttl: float, hold_ttl: float
+    ) -> Optional[str]:
+        """
+        Retiene [start, end) de `service` (normalizado con slots.service_key)
+        por `ttl` segundos si ningún registro lo ocupa: un pendiente creado
+        hace menos de `hold_ttl` o uno AUTHORIZED. Devuelve el id del claim
+        (se suelta con `release_slot`) o None si está ocupado.
+
+        Verificar y retener es atómico entre workers. Sólo lo necesitan los
+        backends sin `broadcasts_changes`: en los demás basta el SlotIndex.
+        """
+        raise NotImplementedError
+
+    async def release_slot(self, claim: str) -> None:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryTransactionStore(TransactionStore):
+    """
+    Dict en memoria. Sólo sirve con un único worker.
+
+    Los vencimientos van en un heap (min por fecha de expiración) con borrado
+    perezoso: reescribir un token deja su entrada vieja en el heap y se
+    descarta al llegar a la cima. Purgar cuesta O(k log n) por los k vencidos,
+    nunca un recorrido completo. `max_entries` acota la memoria: si se supera,
+    se desalojan primero los que vencen antes.
+
+    Los índices son listas ordenadas de (created_at, token), una por valor de
+    cada campo más una general, y se consultan con bisect: O(log n + k).
+    También con borrado perezoso: al cambiar un valor la entrada vieja queda
+    y se ignora al leer (se compara con `_entries`); cuando las obsoletas
+    superan a los registros vivos, `purge_expired` las compacta.
+
+    Con `compact` (default) cada registro se guarda como CompactRecord y se
+    reconstruye como dict al leerlo; `details_fields` recorta el detalle de
+    Transbank a esos campos. Ver bench/memory.py.
+
+    Con `log` (TransactionLog) el contenido sobrevive a un reinicio: cada
+    escritura va al WAL y al crear el store se recupera el último snapshot
+    más el WAL posterior. `run` baja el WAL a disco y toma los snapshots.
+    Ver bench/recovery.py.
+    """
+
+    def __init__(
+        self,
+        policy: Optional[ExpiryPolicy] = None,
+        max_entries: int = 0,
+        *,
+        compact: bool = True,
+        details_fields: Optional[Iterable[str]] = None,
+        log: Optional[TransactionLog] = None,
+    ):
+        super().__init__(policy)
+        self.compact = compact
+        if compact:
+            fields = tuple(details_fields) if details_fields else None
+            self._pack = lambda record: CompactRecord.from_dict(record, fields)
+            self._unpack = CompactRecord.to_dict
+        else:
+            self._pack = self._unpack = dict
+        self._data = {}
+        self._expires_at = {}
+        self._sizes = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._bytes = 0
+        self._locks = {}
+        self._entries = {}  # token -> ((created_at, token), index_values)
+        self._by_created = []
+        self._indexes = {field: {} for field in INDEXED_FIELDS}
+        self._stale = 0
+        self.max_entries = max_entries
+        self._log = log
+        if log is not None:
+            # Millones de objetos de una vez: el GC cíclico los recorrería
+            # una y otra vez sin encontrar nada. Después se congelan para que
+            # las colecciones completas tampoco los recorran.
+            enabled = gc.isenabled()
+            gc.disable()
+            try:
+                self._restore(log.recover())
+            finally:
+                if enabled:
+                    gc.enable()
+            gc.freeze()
+
+    def _restore(self, rows):
+        """
+        Carga masiva de lo recuperado del WAL. Cada fila trae también la
+        entrada de índice, así no hay que reconstruir los registros; cada
+        índice se ordena una sola vez al final.
+
+        Las filas escritas con el otro modo (TRANSACTION_COMPACT cambió entre
+        reinicios) se convierten al actual, con su tamaño y entrada de índice.
+        """
+        now = time.time()
+        foreign = dict if self.compact else CompactRecord
+        data, expires, sizes, entries = self._data, self._expires_at, self._sizes, self._entries
+        heap, by_created, seq = self._heap, self._by_created, self._seq
+        indexes = [self._indexes[field] for field in INDEXED_FIELDS]
+        for token, (expires_at, stored, size, entry, values) in rows.items():
+            if expires_at <= now:
+                continue
+            if isinstance(stored, foreign):
+                stored, size, entry = self._convert(token, stored)
+            data[token] = stored
+            expires[token] = expires_at
+            sizes[token] = size
+            heap.append((expires_at, next(seq), token))
+            entries[token] = (entry, values)
+            by_created.append(entry)
+            for index, value in zip(indexes, values):
+                if value is not None:
+                    index.setdefault(value, []).append(entry)
+        self._bytes = sum(sizes.values())
+        heapq.heapify(heap)
+        by_created.sort()
+        for index in indexes:
+            for index_entries in index.values():
+                index_entries.sort()
+        self._evict(now)
+
+    def _convert(self, token, stored):
+        if self.compact:
+            stored = self._pack(stored)
+            created_at = stored.created_at
+        else:
+            stored = stored.to_dict()
+            created_at = stored.get("created_at", 0.0)
+        return stored, approx_size(stored), (created_at, token)
+
+    def _row(self, token):
+        # Fila del WAL / snapshot: (expires_at, registro, tamaño, entrada de índice, valores)
+        entry, values = self._entries[token]
+        return self._expires_at[token], self._data[token], self._sizes[token], entry, values
+
+    def _capture(self):
+        # Copias de los dicts (en C, rápidas); los registros guardados no se
+        # mutan, se reemplazan, así que las filas se arman después en el thread
+        data, expires, sizes, entries = (
+            dict(self._data), dict(self._expires_at), dict(self._sizes), dict(self._entries)
+        )
+
+        def rows():
+            for token, stored in data.items():
+                entry, values = entries[token]
+                yield token, (expires[token], stored, sizes[token], entry, values)
+
+        return rows
+
+    def _write(self, token, record):
+        expires_at = time.time() + self.policy.ttl_for(record)
+        stored = self._pack(record)
+        size = approx_size(stored)
+        self._bytes += size - self._sizes.get(token, 0)
+        self._sizes[token] = size
+        self._data[token] = stored
+        self._expires_at[token] = expires_at
+        # created_at tal como se va a leer (CompactRecord lo redondea al ms)
+        created_at = stored.created_at if self.compact else record.get("created_at", 0.0)
+        self._index(token, created_at, index_values(record))
+        heapq.heappush(self._heap, (expires_at, next(self._seq), token))
+        if self._log is not None:
+            self._log.append(token, self._row(token))
+        self._evict(time.time())
+
+    def _index(self, token, created_at, values):
+        entry = (created_at, token)
+        old_entry, old_values = self._entries.get(token, (None, (None,) * len(INDEXED_FIELDS)))
+        if entry == old_entry:
+            entry = old_entry
+        else:
+            _insort_unique(self._by_created, entry)
+            if old_entry is not None:
+                self._stale += 1
+        self._entries[token] = (entry, values)
+        for field, value, old in zip(INDEXED_FIELDS, values, old_values):
+            if value == old and entry is old_entry:
+                continue
+            if old is not None:
+                self._stale += 1
+            if value is not None:
+                _insort_unique(self._indexes[field].setdefault(value, []), entry)
+
+    def _is_live(self, entry, pos=None, value=None):
+        current = self._entries.get(entry[1])
+        return (
+            current is not None
+            and current[0] == entry
+            and (pos is None or current[1][pos] == value)
+        )
+
+    def _compact(self):
+        self._by_created = [e for e in self._by_created if self._is_live(e)]
+        for pos, field in enumerate(INDEXED_FIELDS):
+            index = {}
+            for value, entries in self._indexes[field].items():
+                live = [e for e in entries if self._is_live(e, pos, value)]
+                if live:
+                    index[value] = live
+            self._indexes[field] = index
+        self._stale = 0
+
+    def _remove(self, token):
+        self._data.pop(token, None)
+        self._expires_at.pop(token, None)
+        self._bytes -= self._sizes.pop(token, 0)
+        current = self._entries.pop(token, None)
+        if current is not None:
+            self._stale += 1 + sum(value is not None for value in current[1])
+
+    def _evict(self, now):
+        removed = 0
+        heap = self._heap
+        while heap:
+            expires_at, _, token = heap[0]
+            over_cap = self.max_entries and len(self._data) > self.max_entries
+            if expires_at > now and not over_cap:
+                break
+            heapq.heappop(heap)
+            # Entrada obsoleta: el token se reescribió o ya se borró
+            if self._expires_at.get(token) != expires_at:
+                continue
+            # Los vencidos se descartan solos al recuperar; los desalojados no
+            if self._log is not None and expires_at > now:
+                self._log.append_delete(token)
+            self._remove(token)
+            removed += 1
+        return removed
+
+    async def get(self, token):
+        record = self._data.get(token)
+        if record is None:
+            return None
+        if self._expires_at[token] <= time.time():
+            self._remove(token)
+            return None
+        return self._unpack(record)
+
+    async def set(self, token, record):
+        self._write(token, record)
+        self._emit(token, record)
+
+    async def update(self, token, fields):
+        record = await self.get(token)
+        if record is None:
+            return None
+        record.update(fields)
+        self._write(token, record)
+        self._emit(token, record)
+        return dict(record)
+
+    async def delete(self, token):
+        if self._log is not None and token in self._data:
+            self._log.append_delete(token)
+        self._remove(token)
+
+    async def purge_expired(self):
+        removed = self._evict(time.time())
+        if self._stale > len(self._entries):
+            self._compact()
+        return removed
+
+    async def list_pending(self, older_than, limit, after=0.0):
+        pos = INDEXED_FIELDS.index("status")
+        entries = self._indexes["status"].get("pending", [])
+        now = time.time()
+        found = []
+        for i in range(bisect.bisect_left(entries, (after,)), len(entries)):
+            entry = entries[i]
+            if entry[0] > older_than:
+                break
+            token = entry[1]
+            if (
+                entry[0] <= after
+                or not self._is_live(entry, pos, "pending")
+                or self._expires_at[token] <= now
+            ):
+                continue
+            found.append((token, self._unpack(self._data[token])))
+            if len(found) >= limit:
+                break
+        return found
+
+    async def _query(self, field, value, start, end, before, limit):
+        status_pos = INDEXED_FIELDS.index("status")
+        if field is None:
+            pos, entries = None, self._by_created
+        else:
+            pos, entries = INDEXED_FIELDS.index(field), self._indexes[field].get(value, [])
+        hi = len(entries)
+        if end is not None:
+            hi = bisect.bisect_left(entries, (end,), 0, hi)
+        if before is not None:
+            hi = bisect.bisect_left(entries, tuple(before), 0, hi)
+        lo = bisect.bisect_left(entries, (start,), 0, hi) if start is not None else 0
+        now = time.time()
+        found = []
+        for i in range(hi - 1, lo - 1, -1):
+            entry = entries[i]
+            token = entry[1]
+            if not self._is_live(entry, pos, value) or self._expires_at[token] <= now:
+                continue
+            # Los registros con "kind" no tienen estado y no son transacciones
+            if self._entries[token][1][status_pos] is None:
+                continue
+            found.append((token, self._unpack(self._data[token])))
+            if len(found) >= limit:
+                break
+        return found
+
+    async def stats(self):
+        return len(self._data), self._bytes
+
+    async def acquire_lock(self, name, ttl):
+        now = time.time()
+        current = self._locks.get(name)
+        if current is not None and current[1] > now:
+            return None
+        owner = uuid.uuid4().hex
+        self._locks[name] = (owner, now + ttl)
+        return owner
+
+    async def release_lock(self, name, owner):
+        current = self._locks.get(name)
+        if current is not None and current[0] == owner:
+            del self._locks[name]
+
+    async def run(self):
+        if self._log is not None:
+            await self._log.run(self._capture)
+
+    async def close(self):
+        if self._log is not None:
+            await self._log.close()
+
+
+_INDEX_COLUMNS = ", ".join(INDEXED_FIELDS)
+_SLOT_COLUMNS = "slot_service, slot_start, slot_end"
+
+
+class SQLiteTransactionStore(TransactionStore):
+    """
+    SQLite en modo WAL, compartido por todos los workers de la misma máquina.
+
+    Las consultas son bloqueantes y cortas, así que se ejecutan en un thread
+    para no frenar el event loop. `expires_at` está indexado: la purga es un
+    rango sobre el índice, no un recorrido de la tabla.
+
+    SQLite no avisa a los otros procesos: los cambios sólo llegan a los
+    listeners del worker que escribió. Por eso las reservas guardan además su
+    horario en columnas indexadas (`slot_*`) y `claim_slot` verifica los
+    cruces contra la tabla, no contra el índice del proceso.
+    """
+
+    broadcasts_changes = False
+
+    def __init__(self, path: str, policy: Optional[ExpiryPolicy] = None):
+        super().__init__(policy)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS transactions ("
+            " token TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(transactions)")}
+        if "expires_at" not in columns:
+            self._conn.execute("ALTER TABLE transactions ADD COLUMN expires_at REAL")
+        if "created_at" not in columns:
+            for column in INDEXED_FIELDS:
+                self._conn.execute(f"ALTER TABLE transactions ADD COLUMN {column} TEXT")
+            self._conn.execute("ALTER TABLE transactions ADD COLUMN created_at REAL")
+        if "slot_service" not in columns:
+            self._conn.execute("ALTER TABLE transactions ADD COLUMN slot_service TEXT")
+            self._conn.execute("ALTER TABLE transactions ADD COLUMN slot_start REAL")
+            self._conn.execute("ALTER TABLE transactions ADD COLUMN slot_end REAL")
+        if not {"created_at", "slot_service"} <= columns:
+            self._backfill_indexes()
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS transactions_expires_at ON transactions (expires_at)"
+        )
+        self._conn.execute("DROP INDEX IF EXISTS transactions_pending")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS transactions_created_at ON transactions (created_at)"
+        )
+        for column in INDEXED_FIELDS:
+            self._conn.execute(
+                f"CREATE INDEX IF NOT EXISTS transactions_{column}"
+                f" ON transactions ({column}, created_at)"
+            )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS transactions_slot ON transactions (slot_service, slot_end)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS locks ("
+            " name TEXT PRIMARY KEY,"
+            " owner TEXT NOT NULL,"
+            " expires_at REAL NOT NULL)"
+        )
+        # Horarios retenidos mientras se crea la transacción en Transbank
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS slot_claims ("
+            " id TEXT PRIMARY KEY,"
+            " service TEXT NOT NULL,"
+            " start_at REAL NOT NULL,"
+            " end_at REAL NOT NULL,"
+            " expires_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS slot_claims_service ON slot_claims (service, end_at)"
+        )
+
+    def _backfill_indexes(self):
+        # Tablas creadas antes de los índices: se completan las columnas nuevas
+        rows = self._conn.execute("SELECT token, data FROM transactions").fetchall()
+        self._conn.execute("BEGIN")
+        for token, data in rows:
+            record = json.loads(data)
+            self._conn.execute(
+                f"UPDATE transactions SET ({_INDEX_COLUMNS}, created_at, {_SLOT_COLUMNS})"
+                " = (?, ?, ?, ?, ?, ?, ?, ?) WHERE token = ?",
+                (*index_values(record), record.get("created_at", 0.0), *slot_values(record), token),
+            )
+        self._conn.execute("COMMIT")
+
+    async def _run(self, fn, *args):
+        def locked():
+            with self._lock:
+                return fn(*args)
+
+        return await asyncio.to_thread(locked)
+
+    def _get(self, token):
+        row = self._conn.execute(
+            "SELECT data FROM transactions WHERE token = ? AND expires_at > ?",
+            (token, time.time()),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set(self, token, record):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO transactions"
+            f" (token, data, expires_at, {_INDEX_COLUMNS}, created_at, {_SLOT_COLUMNS})"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                token,
+                json.dumps(record),
+                time.time() + self.policy.ttl_for(record),
+                *index_values(record),
+                record.get("created_at", 0.0),
+                *slot_values(record),
+            ),
+        )
+
+    def _update(self, token, fields):
+        # BEGIN IMMEDIATE toma el lock de escritura: el read-modify-write es
+        # atómico también frente a otros procesos.
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            record = self._get(token)
+            if record is not None:
+                record.update(fields)
+                self._set(token, record)
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return record
+
+    def _delete(self, token):
+        self._conn.execute("DELETE FROM transactions WHERE token = ?", (token,))
+
+    def _purge_expired(self):
+        cursor = self._conn.execute(
+            "DELETE FROM transactions WHERE expires_at <= ?", (time.time(),)
+        )
+        return cursor.rowcount
+
+    def _list_pending(self, older_than, limit, after):
+        rows = self._conn.execute(
+            "SELECT token, data FROM transactions"
+            " WHERE status = 'pending' AND created_at > ? AND created_at <= ? AND expires_at > ?"
+            " ORDER BY created_at LIMIT ?",
+            (after, older_than, time.time(), limit),
+        ).fetchall()
+        return [(token, json.loads(data)) for token, data in rows]
+
+    def _query_sync(self, field, value, start, end, before, limit):
+        clauses, params = ["expires_at > ?"], [time.time()]
+        if field is not None:
+            clauses.append(f"{field} = ?")
+            params.append(value)
+        else:
+            # Los registros con "kind" no tienen estado y no son transacciones
+            clauses.append("status IS NOT NULL")
+        if start is not None:
+            clauses.append("created_at >= ?")
+            params.append(start)
+        if end is not None:
+            clauses.append("created_at < ?")
+            params.append(end)
+        if before is not None:
+            clauses.append("(created_at, token) < (?, ?)")
+            params.extend(before)
+        rows = self._conn.execute(
+            f"SELECT token, data FROM transactions WHERE {' AND '.join(clauses)}"
+            " ORDER BY created_at DESC, token DESC LIMIT ?",
+            (*params, limit),
+        ).fetchall()
+        return [(token, json.loads(data)) for token, data in rows]
+
+    def _acquire_lock(self, name, ttl):
+        now = time.time()
+        owner = uuid.uuid4().hex
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute(
+                "DELETE FROM locks WHERE name = ? AND expires_at <= ?", (name, now)
+            )
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO locks (name, owner, expires_at) VALUES (?, ?, ?)",
+                (name, owner, now + ttl),
+            )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return owner if cursor.rowcount == 1 else None
+
+    def _release_lock(self, name, owner):
+        self._conn.execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
+
+    def _claim_slot(self, service, start, end, ttl, hold_ttl):
+        now = time.time()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute("DELETE FROM slot_claims WHERE expires_at <= ?", (now,))
+            taken = self._conn.execute(
+                "SELECT 1 FROM transactions"
+                " WHERE slot_service = ? AND slot_end > ? AND slot_start < ? AND expires_at > ?"
+                " AND (status = ? OR (status = ? AND created_at > ?))"
+                " UNION ALL SELECT 1 FROM slot_claims"
+                " WHERE service = ? AND end_at > ? AND start_at < ?"
+                " LIMIT 1",
+                (
+                    service, start, end, now, CONFIRMED_STATUS, HELD_STATUS, now - hold_ttl,
+                    service, start, end,
+                ),
+            ).fetchone()
+            claim = None
+            if taken is None:
+                claim = uuid.uuid4().hex
+                self._conn.execute(
+                    "INSERT INTO slot_claims (id, service, start_at, end_at, expires_at)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (claim, service, start, end, now + ttl),
+                )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return claim
+
+    def _release_slot(self, claim):
+        self._conn.execute("DELETE FROM slot_claims WHERE id = ?", (claim,))
+
+    def _stats(self):
+        count, size = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM transactions"
+        ).fetchone()
+        return count, size
+
+    async def get(self, token):
+        return await self._run(self._get, token)
+
+    async def set(self, token, record):
+        await self._run(self._set, token, record)
+        self._emit(token, record)
+
+    async def update(self, token, fields):
+        record = await self._run(self._update, token, fields)
+        if record is not None:
+            self._emit(token, record)
+        return record
+
+    async def delete(self, token):
+        await self._run(self._delete, token)
+
+    async def purge_expired(self):
+        return await self._run(self._purge_expired)
+
+    async def list_pending(self, older_than, limit, after=0.0):
+        return await self._run(self._list_pending, older_than, limit, after)
+
+    async def _query(self, field, value, start, end, before, limit):
+        return await self._run(self._query_sync, field, value, start, end, before, limit)
+
+    async def stats(self):
+        return await self._run(self._stats)
+
+    async def acquire_lock(self, name, ttl):
+        return await self._run(self._acquire_lock, name, ttl)
+
+    async def release_lock(self, name, owner):
+        await self._run(self._release_lock, name, owner)
+
+    async def claim_slot(self, service, start, end, ttl, hold_ttl):
+        return await self._run(self._claim_slot, service, start, end, ttl, hold_ttl)
+
+    async def release_slot(self, claim):
+        await self._run(self._release_slot, claim)
+
+    async def close(self):
+        await self._run(self._conn.close)
+
+
+# Registros que se miden para estimar los bytes del store en Redis
+STATS_SAMPLE_SIZE = 32
+
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisTransactionStore(TransactionStore):
+    """
+    Cualquier servidor que hable el protocolo de Redis (Redis, Valkey, KeyDB...).
+
+    La expiración la hace el propio servidor (SET ... EX), así que no hay
+    purga del lado del backend. Cada escritura se publica además en el canal
+    `<prefix>events`; `listen` lo escucha y entrega a los listeners los
+    cambios de todos los workers (incluido el propio).
+
+    Índices: un sorted set por valor (`<prefix>idx:<campo>:<valor>`) y uno
+    general de transacciones (`<prefix>idx:created`, sin los registros con
+    "kind"), con score = created_at. Se actualizan en
+    el mismo MULTI que el registro. Las claves vencen solas pero sus entradas
+    en los índices no: las consultas descartan las que ya no existen, los
+    índices por valor vencen si nadie escribe en ellos durante la vida máxima
+    de un registro, y `purge_expired` recorta el general y los de estado
+    (sólo las entradas cuya clave ya no existe: una reserva pagada puede vivir
+    más que `_lifetime`).
+    """
+
+    def __init__(self, url: str, prefix: str = "tx:", policy: Optional[ExpiryPolicy] = None):
+        super().__init__(policy)
+        # Import diferido: redis sólo es necesario si se elige este backend
+        import redis.asyncio as aioredis
+
+        self._redis = aioredis.from_url(url, decode_responses=True)
+        self._prefix = prefix
+        self._channel = f"{prefix}events"
+        self._statuses_key = f"{prefix}idx:statuses"
+        self._lifetime = int(self.policy.pending_ttl + self.policy.finished_ttl)
+
+    def _key(self, token):
+        return f"{self._prefix}{token}"
+
+    def _index_key(self, field=None, value=None):
+        if field is None:
+            return f"{self._prefix}idx:created"
+        return f"{self._prefix}idx:{field}:{value}"
+
+    def _ttl(self, record):
+        return max(1, int(self.policy.ttl_for(record)))
+
+    async def get(self, token):
+        raw = await self._redis.get(self._key(token))
+        return json.loads(raw) if raw is not None else None
+
+    def _event(self, token, record):
+        return json.dumps({"token": token, "record": record})
+
+    def _unindex(self, pipe, token, old):
+        for field, value in zip(INDEXED_FIELDS, index_values(old)):
+            if value is not None:
+                pipe.zrem(self._index_key(field, value), token)
+        pipe.zrem(self._index_key(), token)
+
+    def _reindex(self, pipe, token, old, record):
+        created_at = record.get("created_at", 0.0)
+        old_values = index_values(old) if old is not None else (None,) * len(INDEXED_FIELDS)
+        values = index_values(record)
+        for field, old_value, value in zip(INDEXED_FIELDS, old_values, values):
+            if old_value is not None and old_value != value:
+                pipe.zrem(self._index_key(field, old_value), token)
+            if value is None:
+                continue
+            key = self._index_key(field, value)
+            pipe.zadd(key, {token: created_at})
+            if field == "status":
+                pipe.sadd(self._statuses_key, value)
+            else:
+                pipe.expire(key, max(self._lifetime, self._ttl(record)))
+        if values[INDEXED_FIELDS.index("status")] is not None:
+            pipe.zadd(self._index_key(), {token: created_at})
+        elif old is not None:
+            pipe.zrem(self._index_key(), token)
+
+    async def _write(self, token, change):
+        """Read-modify-write atómico: `change(actual)` devuelve el registro nuevo o None."""
+        from redis.exceptions import WatchError
+
+        key = self._key(token)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(key)
+                    raw = await pipe.get(key)
+                    old = json.loads(raw) if raw is not None else None
+                    record = change(old)
+                    if record is None:
+                        await pipe.unwatch()
+                        return None
+                    pipe.multi()
+                    pipe.set(key, json.dumps(record), ex=self._ttl(record))
+                    self._reindex(pipe, token, old, record)
+                    pipe.publish(self._channel, self._event(token, record))
+                    await pipe.execute()
+                    return record
+                except WatchError:
+                    # Otro worker modificó el registro entremedio: reintentamos
+                    continue
+
+    async def set(self, token, record):
+        await self._write(token, lambda old: record)
+
+    async def update(self, token, fields):
+        return await self._write(token, lambda old: None if old is None else {**old, **fields})
+
+    async def delete(self, token):
+        raw = await self._redis.get(self._key(token))
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.delete(self._key(token))
+            if raw is not None:
+                self._unindex(pipe, token, json.loads(raw))
+            await pipe.execute()
+
+    async def _trim(self, index_key, cutoff, page_size=1000):
+        """Saca de `index_key` las entradas anteriores a `cutoff` cuya clave ya venció."""
+        removed, offset = 0, 0
+        while True:
+            members = await self._redis.zrangebyscore(
+                index_key, "-inf", cutoff, start=offset, num=page_size
+            )
+            if not members:
+                return removed
+            raws = await self._redis.mget([self._key(token) for token in members])
+            stale = [token for token, raw in zip(members, raws) if raw is None]
+            if stale:
+                removed += await self._redis.zrem(index_key, *stale)
+            # Las que siguen vivas quedan antes en el set: se saltan
+            offset += len(members) - len(stale)
+
+    async def purge_expired(self):
+        now = time.time()
+        removed = await self._trim(self._index_key(), now - self._lifetime)
+        for status in await self._redis.smembers(self._statuses_key):
+            cutoff = now - (self.policy.pending_ttl if status == "pending" else self._lifetime)
+            await self._trim(self._index_key("status", status), cutoff)
+        return removed
+
+    async def _fetch(self, index_key, members):
+        """Registros de `members`; los que ya vencieron se sacan del índice."""
+        raws = await self._redis.mget([self._key(token) for token in members])
+        found, stale = [], []
+        for token, raw in zip(members, raws):
+            if raw is None:
+                stale.append(token)
+            else:
+                found.append((token, json.loads(raw)))
+        if stale:
+            await self._redis.zrem(index_key, *stale)
+        return found
+
+    async def list_pending(self, older_than, limit, after=0.0):
+        key = self._index_key("status", "pending")
+        found = []
+        while len(found) < limit:
+            members = await self._redis.zrangebyscore(
+                key, f"({after}", older_than, start=0, num=limit - len(found), withscores=True
+            )
+            if not members:
+                break
+            after = members[-1][1]
+            found.extend(await self._fetch(key, [token for token, _ in members]))
+        return found
+
+    async def _query(self, field, value, start, end, before, limit):
+        key = self._index_key(field, value)
+        high = f"({end}" if end is not None else "+inf"
+        if before is not None and (end is None or before[0] < end):
+            high = before[0]
+        low = start if start is not None else "-inf"
+        found, offset, stale = [], 0, []
+        while len(found) < limit:
+            members = await self._redis.zrevrangebyscore(
+                key, high, low, start=offset, num=limit, withscores=True
+            )
+            if not members:
+                break
+            offset += len(members)
+            tokens = [
+                token for token, score in members
+                if before is None or (score, token) < tuple(before)
+            ]
+            if not tokens:
+                continue
+            raws = await self._redis.mget([self._key(token) for token in tokens])
+            for token, raw in zip(tokens, raws):
+                if raw is None:
+                    stale.append(token)
+                    continue
+                found.append((token, json.loads(raw)))
+                if len(found) >= limit:
+                    break
+        if stale:
+            # Al final: sacarlos antes correría el offset de la paginación
+            await self._redis.zrem(key, *stale)
+        return found
+
+    async def stats(self):
+        # Cantidad según el índice general (purge_expired lo acaba de
+        # recortar); bytes estimados con el largo del JSON de una muestra
+        count = await self._redis.zcard(self._index_key())
+        if not count:
+            return 0, 0
+        sample = await self._redis.zrandmember(self._index_key(), STATS_SAMPLE_SIZE)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for token in sample:
+                pipe.strlen(self._key(token))
+            sizes = [size for size in await pipe.execute() if size]
+        return count, int(count * sum(sizes) / len(sizes)) if sizes else 0
+
+    async def acquire_lock(self, name, ttl):
+        owner = uuid.uuid4().hex
+        acquired = await self._redis.set(
+            f"{self._prefix}lock:{name}", owner, nx=True, px=int(ttl * 1000)
+        )
+        return owner if acquired else None
+
+    async def release_lock(self, name, owner):
+        # Comparar y borrar en un solo paso: no liberar un lock que ya venció
+        # y tomó otro worker
+        await self._redis.eval(_RELEASE_LOCK_SCRIPT, 1, f"{self._prefix}lock:{name}", owner)
+
+    async def listen(self):
+        while True:
+            try:
+                async with self._redis.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.subscribe(self._channel)
+                    async for message in pubsub.listen():
+                        event = json.loads(message["data"])
+                        self._emit(event["token"], event["record"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Conexión caída: quien espera cambios sigue con su timeout;
+                # reintentamos la suscripción
+                logger.exception("Error en la suscripción a %s", self._channel)
+                await asyncio.sleep(1)
+
+    async def close(self):
+        await self._redis.aclose()
+
+
+def _transaction_log_from_env() -> Optional[TransactionLog]:
+    directory = os.getenv("TRANSACTION_WAL_DIR")
+    if not directory:
+        return None
+    return TransactionLog(
+        directory,
+        fsync_interval=float(os.getenv("TRANSACTION_WAL_FSYNC_INTERVAL", 0.01)),
+        snapshot_interval=float(os.getenv("TRANSACTION_SNAPSHOT_INTERVAL", 300)),
+        snapshot_wal_bytes=int(os.getenv("TRANSACTION_SNAPSHOT_WAL_BYTES", 64 * 1024 * 1024)),
+    )
+
+
+def create_store() -> TransactionStore:
+    """Elige el backend según TRANSACTION_STORE: memory (default), sqlite o redis."""
+    backend = os.getenv("TRANSACTION_STORE", "memory").lower()
+    policy = ExpiryPolicy.from_env()
+    if backend == "memory":
+        details_fields = os.getenv("TRANSACTION_DETAILS_FIELDS")
+        return MemoryTransactionStore(
+            policy,
+            max_entries=int(os.getenv("TRANSACTION_MAX_ENTRIES", 0)),
+            compact=os.getenv("TRANSACTION_COMPACT", "1") != "0",
+            details_fields=details_fields.split(",") if details_fields else None,
+            log=_transaction_log_from_env(),
+        )
+    if backend == "sqlite":
+        return SQLiteTransactionStore(
+            os.getenv("TRANSACTION_STORE_PATH", "transactions.db"), policy
+        )
+    if backend == "redis":
+        return RedisTransactionStore(
+            os.getenv("REDIS_URL", "redis://localhost:6379/0"), policy=policy
+        )
+    raise ValueError(f"TRANSACTION_STORE desconocido: {backend}")
+
+
+async def maintenance_loop(store: TransactionStore, interval: float) -> None:
+    """Purga vencidos y actualiza los gauges del store cada `interval` segundos."""
+    while True:
+        try:
+            await store.purge_expired()
+            stats = await store.stats()
+            if stats is not None:
+                metrics.TRANSACTIONS_ENTRIES.set(stats[0])
+                metrics.TRANSACTIONS_BYTES.set(stats[1])
+        except Exception:
+            logger.exception("Error en mantenimiento del store")
+        await asyncio.sleep(interval)
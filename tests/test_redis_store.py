@@ -0,0 +1,222 @@
+"""
+RedisTransactionStore contra fakeredis (un servidor Redis en proceso).
+
+Dos stores sobre el mismo FakeServer hacen de dos workers que comparten el
+servidor.
+
+    pip install -r requirements-dev.txt
+    python -m pytest tests
+"""
+import asyncio
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from store import ExpiryPolicy, RedisTransactionStore  # noqa: E402
+
+
+def make_store(server, policy=None):
+    store = RedisTransactionStore("redis://unused", policy=policy or ExpiryPolicy())
+    store._redis = fakeredis.aioredis.FakeRedis(server=server, decode_responses=True)
+    return store
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def reserva(token_n, status="pending", created_at=None, email="ana@example.com"):
+    return {
+        "status": status,
+        "buy_order": f"RES{token_n}",
+        "amount": 20000,
+        "created_at": created_at if created_at is not None else time.time(),
+        "reserva_data": {"name": "Ana", "email": email, "phone": "+56 9 1234 5678"},
+    }
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def test_set_get_update_delete(server):
+    async def main():
+        store = make_store(server, ExpiryPolicy(pending_ttl=600, finished_ttl=86400))
+        await store.set("t1", reserva(1))
+        assert (await store.get("t1"))["buy_order"] == "RES1"
+        assert 0 < await store._redis.ttl("tx:t1") <= 600
+
+        updated = await store.update("t1", {"status": "AUTHORIZED"})
+        assert updated["status"] == "AUTHORIZED" and updated["amount"] == 20000
+        # Finalizado: pasa a la retención larga
+        assert await store._redis.ttl("tx:t1") > 600
+        assert await store.update("missing", {"status": "FAILED"}) is None
+        assert await store.get("missing") is None
+
+        await store.delete("t1")
+        assert await store.get("t1") is None
+        assert await store.query("buy_order", "RES1") == []
+        await store.close()
+
+    run(main())
+
+
+def test_concurrent_updates_are_atomic(server):
+    async def main():
+        a, b = make_store(server), make_store(server)
+        await a.set("t1", {"status": "pending", "n": 0, "created_at": time.time()})
+
+        def increment(old):
+            return {**old, "n": old["n"] + 1}
+
+        await asyncio.gather(*(store._write("t1", increment) for store in (a, b) for _ in range(10)))
+        assert (await a.get("t1"))["n"] == 20
+        await a.close()
+        await b.close()
+
+    run(main())
+
+
+def test_query_indexes_and_pagination(server):
+    async def main():
+        store = make_store(server)
+        now = time.time()
+        for i in range(7):
+            await store.set(f"t{i}", reserva(i, created_at=now - 100 + i))
+        await store.set("other", reserva(99, created_at=now, email="otro@example.com"))
+        await store.update("t3", {"status": "AUTHORIZED"})
+
+        # Email y teléfono normalizados, del más nuevo al más antiguo
+        page = await store.query("email", " ANA@example.com", limit=3)
+        assert [token for token, _ in page] == ["t6", "t5", "t4"]
+        last_token, last = page[-1]
+        page = await store.query("email", "ana@example.com", before=(last["created_at"], last_token), limit=10)
+        assert [token for token, _ in page] == ["t3", "t2", "t1", "t0"]
+        assert len(await store.query("phone", "+56912345678", limit=50)) == 8
+
+        # El cambio de estado mueve el token de índice
+        pending = [token for token, _ in await store.query("status", "pending", limit=50)]
+        assert "t3" not in pending and len(pending) == 7
+        assert [token for token, _ in await store.query("status", "AUTHORIZED")] == ["t3"]
+
+        # Rango [start, end) sobre created_at
+        window = await store.query(start=now - 98, end=now - 95)
+        assert [token for token, _ in window] == ["t4", "t3", "t2"]
+
+        # Un registro vencido sale del resultado y de su índice
+        await store._redis.delete("tx:t6")
+        assert "t6" not in [token for token, _ in await store.query("email", "ana@example.com")]
+        assert await store._redis.zscore("tx:idx:email:ana@example.com", "t6") is None
+        await store.close()
+
+    run(main())
+
+
+def test_list_pending_pages_oldest_first(server):
+    async def main():
+        store = make_store(server)
+        now = time.time()
+        for i in range(5):
+            await store.set(f"t{i}", reserva(i, created_at=now - 500 + i))
+        await store.set("fresh", reserva(9, created_at=now))
+        await store.update("t1", {"status": "FAILED"})
+
+        page = await store.list_pending(now - 300, limit=2)
+        assert [token for token, _ in page] == ["t0", "t2"]
+        page = await store.list_pending(now - 300, limit=10, after=page[-1][1]["created_at"])
+        assert [token for token, _ in page] == ["t3", "t4"]
+        await store.close()
+
+    run(main())
+
+
+def test_purge_expired_trims_indexes(server):
+    async def main():
+        store = make_store(server, ExpiryPolicy(pending_ttl=10, finished_ttl=10))
+        now = time.time()
+        await store.set("old", reserva(1, created_at=now - 1000))
+        await store.set("new", reserva(2, created_at=now))
+        # Pagada hace tiempo pero para una hora futura: sigue viva y en los índices
+        paid = reserva(3, status="AUTHORIZED", created_at=now - 1000)
+        paid["reserva_data"].update(
+            service_name="Corte",
+            start_time=datetime.fromtimestamp(now + 3600, timezone.utc).isoformat(),
+            end_time=datetime.fromtimestamp(now + 7200, timezone.utc).isoformat(),
+        )
+        await store.set("paid", paid)
+        assert await store._redis.ttl("tx:paid") > 3600
+        # El servidor ya venció la clave de "old"
+        await store._redis.delete("tx:old")
+        assert await store.purge_expired() == 1
+        assert await store._redis.zrange("tx:idx:created", 0, -1) == ["paid", "new"]
+        assert await store._redis.zrange("tx:idx:status:pending", 0, -1) == ["new"]
+        assert await store._redis.zrange("tx:idx:status:AUTHORIZED", 0, -1) == ["paid"]
+        await store.close()
+
+    run(main())
+
+
+def test_locks_are_shared_and_owned(server):
+    async def main():
+        a, b = make_store(server), make_store(server)
+        owner = await a.acquire_lock("confirm:t1", 30)
+        assert owner is not None
+        assert await b.acquire_lock("confirm:t1", 30) is None
+
+        # Sólo el dueño lo libera
+        await b.release_lock("confirm:t1", "otro")
+        assert await b.acquire_lock("confirm:t1", 30) is None
+        await a.release_lock("confirm:t1", owner)
+        assert await b.acquire_lock("confirm:t1", 30) is not None
+
+        # Vence solo
+        assert await a.acquire_lock("short", 0.05) is not None
+        await asyncio.sleep(0.1)
+        assert await b.acquire_lock("short", 30) is not None
+        await a.close()
+        await b.close()
+
+    run(main())
+
+
+def test_pubsub_delivers_writes_from_other_workers(server):
+    async def main():
+        a, b = make_store(server), make_store(server)
+        received = []
+        b.add_listener(lambda token, record: received.append((token, record["status"])))
+        listener = asyncio.create_task(b.listen())
+        await asyncio.sleep(0.1)
+
+        await a.set("t1", reserva(1))
+        await a.update("t1", {"status": "AUTHORIZED"})
+        deadline = time.monotonic() + 2
+        while len(received) < 2 and time.monotonic() < deadline:
+            await asyncio.sleep(0.02)
+        assert received == [("t1", "pending"), ("t1", "AUTHORIZED")]
+
+        listener.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await listener
+        await a.close()
+        await b.close()
+
+    run(main())
+
+
+def test_stats_counts_transactions(server):
+    async def main():
+        store = make_store(server)
+        assert await store.stats() == (0, 0)
+        for n in range(5):
+            await store.set(f"t{n}", reserva(n))
+        await store.set("idem:x", {"kind": "idempotency", "response": {}, "created_at": time.time()})
+        count, size = await store.stats()
+        assert count == 5
+        assert size == sum([await store._redis.strlen(f"tx:t{n}") for n in range(5)])
+        await store.close()
+
+    run(main())
@@ -0,0 +1,91 @@
+import math
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+
+
+class TimerWheel:
+    """
+    Rueda de timers jerárquica (Varghese & Lauck): `levels` ruedas de
+    `slots` casilleros; un casillero del nivel L abarca slots**L ticks de
+    `resolution` segundos.
+
+    Programar y cancelar son O(1). Cada tick vacía un casillero del nivel 0
+    y, cuando una rueda da la vuelta, reparte el casillero siguiente del
+    nivel de arriba en los de abajo: cada timer baja a lo más `levels - 1`
+    veces, así que el costo por tick no depende de cuántos timers haya
+    pendientes, sólo de cuántos vencen.
+
+    Los plazos más allá de la rueda de arriba se guardan ahí y se vuelven a
+    ubicar cada vez que les toca el casillero.
+    """
+
+    def __init__(self, resolution: float = 1.0, slots: int = 64, levels: int = 4, now: float = 0.0):
+        self.resolution = resolution
+        self._slots = slots
+        self._spans = [slots ** level for level in range(levels)]
+        self._wheels: List[List[Set[Hashable]]] = [
+            [set() for _ in range(slots)] for _ in range(levels)
+        ]
+        # key -> (tick de vencimiento, nivel, casillero)
+        self._timers: Dict[Hashable, Tuple[int, int, int]] = {}
+        self._tick = int(now // resolution)
+
+    def __len__(self) -> int:
+        return len(self._timers)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._timers
+
+    def _place(self, key: Hashable, tick: int) -> None:
+        delta = tick - self._tick
+        level = 0
+        while level < len(self._spans) - 1 and delta >= self._spans[level + 1]:
+            level += 1
+        slot = (tick // self._spans[level]) % self._slots
+        self._wheels[level][slot].add(key)
+        self._timers[key] = (tick, level, slot)
+
+    def schedule(self, key: Hashable, deadline: float) -> None:
+        """Programa (o reprograma) `key` para `deadline` (epoch); vence en el primer tick >= deadline."""
+        self.cancel(key)
+        tick = max(math.ceil(deadline / self.resolution), self._tick + 1)
+        self._place(key, tick)
+
+    def cancel(self, key: Hashable) -> bool:
+        timer = self._timers.pop(key, None)
+        if timer is None:
+            return False
+        _, level, slot = timer
+        self._wheels[level][slot].discard(key)
+        return True
+
+    def deadline(self, key: Hashable) -> Optional[float]:
+        timer = self._timers.get(key)
+        return timer[0] * self.resolution if timer is not None else None
+
+    def advance(self, now: float) -> List[Hashable]:
+        """Avanza hasta `now` y devuelve las keys vencidas, en orden de vencimiento."""
+        target = int(now // self.resolution)
+        expired = []
+        while self._tick < target:
+            self._tick += 1
+            # De arriba hacia abajo: lo que baja de un nivel puede caer en el
+            # casillero del nivel inferior que se reparte en este mismo tick
+            for level in range(len(self._spans) - 1, 0, -1):
+                span = self._spans[level]
+                if self._tick % span:
+                    continue
+                slot = (self._tick // span) % self._slots
+                bucket, self._wheels[level][slot] = self._wheels[level][slot], set()
+                for key in bucket:
+                    self._place(key, self._timers[key][0])
+            slot = self._tick % self._slots
+            bucket, self._wheels[0][slot] = self._wheels[0][slot], set()
+            for key in bucket:
+                tick = self._timers[key][0]
+                if tick <= self._tick:
+                    del self._timers[key]
+                    expired.append(key)
+                else:
+                    # Plazo más allá de la rueda de arriba: sigue esperando
+                    self._place(key, tick)
+        return expired
@@ -0,0 +1,143 @@
+import asyncio
+import time
+from datetime import datetime
+from typing import Optional
+
+import httpx
+
+import metrics
+from metrics import track_upstream
+from resilience import AdaptiveTimeout, CircuitBreaker, CircuitOpenError
+
+TRANSACTIONS_PATH = "/rswebpaytransaction/api/webpay/v1.2/transactions"
+
+
+class TransbankError(Exception):
+    """Respuesta no exitosa (distinta de 200) de la API de Transbank."""
+
+    def __init__(self, status_code: int, text: str):
+        super().__init__(f"Transbank respondió {status_code}: {text}")
+        self.status_code = status_code
+        self.text = text
+
+
+class TransbankUnavailable(Exception):
+    """Transbank no responde (timeout, error de red, 5xx) o el circuito está abierto."""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class TransbankClient:
+    """
+    Cliente async de Webpay Plus (API REST v1.2).
+
+    Mantiene un único pool de conexiones keep-alive hacia Transbank, así cada
+    petición reutiliza la conexión TLS en vez de abrir una nueva.
+
+    Cada endpoint (create, commit, status) tiene su propio timeout adaptativo según
+    la latencia observada, y todas las llamadas pasan por un circuit breaker:
+    durante una caída de Transbank se falla de inmediato con
+    TransbankUnavailable en vez de acumular requests colgados.
+    """
+
+    def __init__(
+        self,
+        commerce_code: str,
+        api_key: str,
+        base_url: str,
+        *,
+        timeout: float = 30.0,
+        min_timeout: float = 2.0,
+        timeout_factor: float = 3.0,
+        breaker_failures: int = 5,
+        breaker_reset: float = 30.0,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+    ):
+        self._timeouts = {
+            upstream: AdaptiveTimeout(minimum=min_timeout, maximum=timeout, factor=timeout_factor)
+            for upstream in ("transbank_create", "transbank_commit", "transbank_status")
+        }
+        self._breaker = CircuitBreaker(
+            "transbank", failure_threshold=breaker_failures, reset_timeout=breaker_reset
+        )
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            headers={
+                "Tbk-Api-Key-Id": commerce_code,
+                "Tbk-Api-Key-Secret": api_key,
+                "Content-Type": "application/json",
+            },
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+            ),
+        )
+
+    async def _request(
+        self, upstream: str, method: str, path: str, json: Optional[dict] = None
+    ) -> dict:
+        try:
+            self._breaker.before_call()
+        except CircuitOpenError as e:
+            raise TransbankUnavailable(str(e), e.retry_after) from e
+
+        adaptive = self._timeouts[upstream]
+        timeout = adaptive.current
+        metrics.UPSTREAM_TIMEOUT.labels(upstream).set(timeout)
+        headers = {"Date": datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT")}
+        start = time.perf_counter()
+        try:
+            with track_upstream(upstream):
+                # Los timeouts de httpx son por fase (connect, read...); wait_for
+                # acota además el total de la llamada
+                response = await asyncio.wait_for(
+                    self._client.request(method, path, json=json, headers=headers, timeout=timeout),
+                    timeout,
+                )
+                if response.status_code != 200:
+                    raise TransbankError(response.status_code, response.text)
+        except (httpx.TransportError, asyncio.TimeoutError) as e:
+            # Timeouts y errores de conexión: Transbank no está sano
+            self._breaker.record_failure()
+            raise TransbankUnavailable(
+                f"Transbank no responde ({type(e).__name__})", self._breaker.reset_timeout
+            ) from e
+        except TransbankError as e:
+            if e.status_code >= 500:
+                self._breaker.record_failure()
+            else:
+                # Un 4xx (token inválido, ya confirmada...) es una respuesta sana
+                self._breaker.record_success()
+            raise
+        except BaseException:
+            self._breaker.release()
+            raise
+
+        self._breaker.record_success()
+        adaptive.observe(time.perf_counter() - start)
+        return response.json()
+
+    async def create_transaction(
+        self, buy_order: str, session_id: str, amount: int, return_url: str
+    ) -> dict:
+        payload = {
+            "buy_order": buy_order,
+            "session_id": session_id,
+            "amount": amount,
+            "return_url": return_url,
+        }
+        return await self._request("transbank_create", "POST", TRANSACTIONS_PATH, json=payload)
+
+    async def commit_transaction(self, token: str) -> dict:
+        return await self._request("transbank_commit", "PUT", f"{TRANSACTIONS_PATH}/{token}")
+
+    async def get_transaction_status(self, token: str) -> dict:
+        """Estado de una transacción sin confirmarla (consultable hasta 7 días)."""
+        return await self._request("transbank_status", "GET", f"{TRANSACTIONS_PATH}/{token}")
+
+    async def aclose(self) -> None:
+        await self._client.aclose()